@@ -10,6 +10,9 @@
 # - Expression is well-formed (no syntax errors)
 
 # %%
+import operator
+import re
+from functools import lru_cache
 from typing import List, Tuple, Union
 
 
@@ -44,46 +47,42 @@ parse_expression_naive("2 + 5 * 3")
 # %%
 
 
+PRECEDENCE: dict[str, int] = {"+": 1, "-": 1, "*": 2}
+
+APPLY = {"+": operator.add, "-": operator.sub, "*": operator.mul}
+
+
 def parse_expression(expression: str) -> int:
     """
     Parses an arithmetic expression respecting operator precedence.
-    This solution handles * and / before + and - by processing in two passes.
+    This solution uses a single shunting-yard pass: operands go on one stack,
+    operators on another, and an operator is applied as soon as the next one
+    does not bind more tightly.
     """
     tokens: List[str] = expression.split()
+    values: List[int] = [int(tokens[0])]
+    ops: List[str] = []
 
-    # First pass: handle multiplication and division
-    i = 1
-    while i < len(tokens) - 1:
-        op = tokens[i]
-        if op in ("*"):
-            left = int(tokens[i - 1])
-            right = int(tokens[i + 1])
-            result = left * right
-
-            # Replace the three tokens with the result
-            tokens[i - 1 : i + 2] = [str(result)]
-
-            # Note that this uses a comfortable Python feature:
-            # the list comprehension syntax.
-            # tokens[i - 1 : i + 2] = [str(result)] is equivalent to
-            # tokens[i - 1] = str(result)
-            # remove tokens[i] and tokens[i + 1]
-        else:
-            i += 2
+    def reduce() -> None:
+        op = ops.pop()
+        right = values.pop()
+        left = values.pop()
+        values.append(APPLY[op](left, right))
 
-    # Second pass: handle addition and subtraction
-    result = int(tokens[0])
-    i = 1
-    while i < len(tokens) - 1:
+    for i in range(1, len(tokens) - 1, 2):
         op = tokens[i]
-        right = int(tokens[i + 1])
-        if op == "+":
-            result += right
-        elif op == "-":
-            result -= right
-        i += 2
+        # Apply pending operators with higher or equal precedence first
+        # (equal precedence: evaluate left to right)
+        while ops and PRECEDENCE[ops[-1]] >= PRECEDENCE[op]:
+            reduce()
+        ops.append(op)
+        values.append(int(tokens[i + 1]))
 
-    return result
+    # Apply whatever is left on the operator stack
+    while ops:
+        reduce()
+
+    return values[0]
 
 
 # %%
@@ -96,23 +95,27 @@ parse_expression("2 + 5 * 3")
 # We have used quite a few Python features here. What if we only had memory and pointers?
 
 
+# Leading spaces, then the digits of the integer (possibly none)
+INT_PATTERN = re.compile(r" *(\d*)")
+
+
 def parse_int(
     expression: str, i: int
 ) -> Tuple[int, int]:  # returns an integer and the next index
     """
     Parses an integer from the expression starting at index i.
+    The scan itself is done by the regular expression engine.
     """
-    result: int = 0
-    while i < len(expression) and expression[i] == " ":
-        i += 1
-    while i < len(expression) and expression[i].isdigit():
-        result = result * 10 + int(expression[i])
-        i += 1
-    return (result, i)
+    m = INT_PATTERN.match(expression, i)
+    assert m is not None  # the pattern also matches the empty string
+    return (int(m.group(1) or 0), m.end())
 
 
-# Q: Why is this function returning int | None?
-def parse_expression_naive_classic(expression: str) -> int | None:
+# Q: Why is it safe to cache the result on the input string?
+# Q: Why is an invalid expression reported by raising an error, rather than
+#    by printing a message? (Hint: what happens the second time?)
+@lru_cache(maxsize=1024)
+def parse_expression_naive_classic(expression: str) -> int:
     """
     Parses an arithmetic expression using a naive iteration approach.
     """
@@ -121,9 +124,6 @@ def parse_expression_naive_classic(expression: str) -> int | None:
     i = next_token[1]
     state = ""
     while i < len(expression):
-        print(
-            f"accumulator: {accumulator}, state: {state}, i: {i}, expression[i]: {expression[i:]}"
-        )
         if state == "":
             if expression[i] == " ":
                 i += 1
@@ -151,8 +151,7 @@ def parse_expression_naive_classic(expression: str) -> int | None:
             state = ""
             continue
         else:
-            print(f"Error: Invalid state: {state}")
-            return None
+            raise ValueError(f"Invalid state: {state}")
     return accumulator
 
 
@@ -167,18 +166,25 @@ parse_expression_naive_classic("2 + 5 * 3")
 
 #Solution 1
 
+# Lookup tables indexed by byte value: 1 for an opening bracket, and for each
+# closing bracket the byte of the matching opening one (0 for anything else)
+OPENING = bytearray(int(b in b"([{") for b in range(256))
+PAIRS = {ord(")"): ord("("), ord("]"): ord("["), ord("}"): ord("{")}
+MATCHING = bytearray(PAIRS.get(b, 0) for b in range(256))
+
+
 def balanced_parentheses(expression: str) -> bool:
-    stack = []
-    couples = {')': '(', ']': '[', '}': '{'} 
-    
-    for c in expression:
-        if c in "([{":
-            stack.append(c)
-        elif c in ")]}":
-            if not stack or stack[-1] != couples[c]:
+    data = expression.encode()
+    stack = bytearray(len(data))  # can never hold more than len(data) brackets
+    sp = 0  # stack pointer: number of brackets currently on the stack
+
+    for b in data:
+        if OPENING[b]:
+            stack[sp] = b
+            sp += 1
+        elif MATCHING[b]:
+            if sp == 0 or stack[sp - 1] != MATCHING[b]:
                 return False
-            stack.pop()
-    
-    return len(stack) == 0
-
+            sp -= 1
 
+    return sp == 0
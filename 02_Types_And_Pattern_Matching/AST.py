@@ -10,24 +10,43 @@
 # Type definitions
 
 from __future__ import annotations
+import io
+import operator
+import re
+from array import array
+from collections.abc import Iterable, Iterator
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Literal
 
-@dataclass
+# Nodes are immutable, so that an AST can be safely shared: parse caches its
+# results, which is only safe because nodes cannot be mutated
+@dataclass(slots=True, frozen=True)
 class Operator:
     operator: str  # Could be Literal["+", "-", "*"]
-    arguments: list[Expr]
+    left: Expr
+    right: Expr
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Constant:
     value: int
 
 type Expr = Constant | Operator
 
+# Constants are immutable, so small ones can be shared between trees
+# (the same trick CPython uses for small ints)
+SMALL_CONSTANTS = {i: Constant(value=i) for i in range(-128, 257)}
+
+def make_constant(value: int) -> Constant:
+    """Return a shared Constant for small values, a fresh one otherwise"""
+    constant = SMALL_CONSTANTS.get(value)
+    return constant if constant is not None else Constant(value=value)
+
 # Example: "3 + 2" 
 expr = Operator(
     operator="+",
-    arguments=[Constant(value=3), Constant(value=2)]
+    left=Constant(value=3),
+    right=Constant(value=2)
 )
 
 # Example: "3" 
@@ -35,64 +54,83 @@ expr2 = Constant(value=3)
 
 # %%
 
-# Parser: parse a string into an AST (plain recursive version, left-to-right)
-def parse(expression: str) -> Expr:
+# Lexer: integers, operators, and any other non-space character
+# (the latter is then rejected by the parser).
+# Operands and operators alternate, so the lexer knows which one comes next:
+# where an operand is expected, a "-" directly followed by digits is the sign
+# of a negative literal ("1 - -5"), elsewhere it is the operator ("1-5").
+OPERAND_PATTERN = re.compile(r"\s*(-?\d+|[+\-*]|\S)")
+OPERATOR_PATTERN = re.compile(r"\s*(\d+|[+\-*]|\S)")
+
+OPERATORS = frozenset(["+", "-", "*"])
+
+def tokenize(expression: str) -> Iterator[str]:
+    """Lazily split an expression into tokens, in a single left-to-right scan"""
+    pos = 0
+    operand = True
+    while True:
+        pattern = OPERAND_PATTERN if operand else OPERATOR_PATTERN
+        m = pattern.match(expression, pos)
+        if m is None:  # only spaces left
+            return
+        yield m.group(1)
+        pos = m.end()
+        operand = not operand
+
+# Parser: parse a string into an AST (iterative version, left-to-right)
+# Parsing is a pure function of the input string, so results are cached
+# (see Operator for why sharing them is safe)
+@lru_cache(maxsize=1024)
+def parse(expression: str, fold: bool = False) -> Expr:
     """Parse an arithmetic expression into an AST.
-    Expression is space-separated like "2 + 5 - 3 * 4"
+    Expression is like "2 + 5 - 3 * 4" (spaces are optional)
     Evaluates left-to-right ignoring precedence.
+    With fold=True, constant sub-expressions are computed while parsing.
     """
-    tokens = expression.split()
-    return parse_tokens(tokens)
-
-def parse_tokens(tokens: list[str]) -> Expr:
-    """Recursively parse tokens into an AST, left-to-right"""
-    match tokens:
-        case []:
-            raise ValueError("Empty expression")
-        case [num]:
-            return Constant(value=int(num))
-        case [num, op, *rest] if op in ["+", "-", "*"]:
-            # Start with first number and build left-to-right
-            left = Constant(value=int(num))
-            return parse_left_to_right(left, op, rest)
-        case _:
-            raise ValueError(f"Invalid tokens: {tokens}")
+    return parse_tokens(tokenize(expression), fold)
+
+def parse_tokens(tokens: Iterable[str], fold: bool = False) -> Expr:
+    """Parse tokens into an AST, left-to-right, in a single pass.
 
-def parse_left_to_right(left: Expr, op: str, tokens: list[str]) -> Expr:
-    """Build AST left-to-right with accumulator"""
-    match tokens:
-        case []:
+    Without precedence or parentheses, the operator stack of the
+    shunting-yard algorithm collapses to a single accumulator: the
+    tree built so far becomes the left operand of the next operator.
+
+    When fold is set, an operator whose operands are both constants is
+    replaced by the constant it evaluates to (constant folding).
+    """
+    it = iter(tokens)
+    first = next(it, None)
+    if first is None:
+        raise ValueError("Empty expression")
+    left: Expr = make_constant(int(first))
+    for op in it:
+        if op not in OPERATORS:
+            raise ValueError(f"Invalid token: {op}")
+        num = next(it, None)
+        if num is None:
             raise ValueError("Operator without right operand")
-        case [num]:
-            # Final operand
-            return Operator(operator=op, arguments=[left, Constant(value=int(num))])
-        case [num, next_op, *rest] if next_op in ["+", "-", "*"]:
-            # Build current operation and continue
-            current = Operator(operator=op, arguments=[left, Constant(value=int(num))])
-            return parse_left_to_right(current, next_op, rest)
-        case _:
-            raise ValueError(f"Invalid tokens: {tokens}")
+        if fold and isinstance(left, Constant):
+            left = make_constant(OPS[op](left.value, int(num)))
+            continue
+        left = Operator(operator=op, left=left, right=make_constant(int(num)))
+    return left
 
 # %%
 
 # Evaluator: evaluate an AST to get the result
+OPS = {"+": operator.add, "-": operator.sub, "*": operator.mul}
+
 def evaluate(expr: Expr) -> int:
     """Evaluate an arithmetic expression AST"""
     match expr:
         case Constant(value=v):
             return v
-        case Operator(operator=op, arguments=[left, right]):
-            left_val = evaluate(left)
-            right_val = evaluate(right)
-            match (left_val, op, right_val):
-                case (int(l), "+", int(r)):
-                    return l + r
-                case (int(l), "-", int(r)):
-                    return l - r
-                case (int(l), "*", int(r)):
-                    return l * r
-                case _:
-                    raise ValueError(f"Invalid operation: {left_val} {op} {right_val}")
+        case Operator(operator=op, left=left, right=right):
+            fn = OPS.get(op)
+            if fn is None:
+                raise ValueError(f"Invalid operator: {op}")
+            return fn(evaluate(left), evaluate(right))
         case _:
             raise ValueError(f"Invalid expression: {expr}")
 
@@ -100,17 +138,94 @@ def evaluate(expr: Expr) -> int:
 
 # Pretty-printer: display AST in a readable tree format
 def pretty_print(expr: Expr, indent: int = 0) -> str:
-    """Pretty print an AST with tree structure"""
-    prefix = "  " * indent
-    match expr:
-        case Constant(value=v):
-            return f"{prefix}{v}"
-        case Operator(operator=op, arguments=[left, right]):
-            left_str = pretty_print(left, indent + 1)
-            right_str = pretty_print(right, indent + 1)
-            return f"{prefix}({op})\n{left_str}\n{right_str}"
-        case _:
-            return f"{prefix}<invalid>"
+    """Pretty print an AST with tree structure.
+    Nodes are visited in preorder with an explicit stack, and every line is
+    written into a single buffer instead of concatenating sub-results.
+    """
+    buffer = io.StringIO()
+    stack: list[tuple[Expr, int]] = [(expr, indent)]
+    first = True
+    while stack:
+        node, depth = stack.pop()
+        if not first:
+            buffer.write("\n")
+        first = False
+        buffer.write("  " * depth)
+        match node:
+            case Constant(value=v):
+                buffer.write(str(v))
+            case Operator(operator=op, left=left, right=right):
+                buffer.write(f"({op})")
+                stack.append((right, depth + 1))
+                stack.append((left, depth + 1))
+            case _:
+                buffer.write("<invalid>")
+    return buffer.getvalue()
+
+# %%
+
+# Alternative representation: the AST as parallel arrays ("struct of arrays").
+# Nodes are numbered in postorder, so operands always come before the operator
+# using them, and the whole tree is evaluated by one left-to-right sweep
+# over contiguous memory instead of by chasing pointers between objects.
+
+CONST, ADD, SUB, MUL = 0, 1, 2, 3
+OP_CODES = {"+": ADD, "-": SUB, "*": MUL}
+
+type SoA = tuple[array[int], array[int], array[int]]
+
+# Range of the 64-bit signed integers held by an array("q")
+INT64_MIN, INT64_MAX = -(2**63), 2**63 - 1
+
+def compile_to_soa(expr: Expr) -> SoA:
+    """Flatten an AST into postorder (op_code, lhs, rhs) arrays.
+    For a constant, lhs holds its value; for an operator, lhs and rhs
+    hold the indices of its operands.
+    Constants must fit in 64 bits (INT64_MIN..INT64_MAX), otherwise a
+    ValueError is raised; results computed by evaluate_soa have no limit.
+    """
+    op_code, lhs, rhs = array("b"), array("q"), array("q")
+    operands: list[int] = []  # indices of nodes waiting for their operator
+    stack: list[tuple[Expr, bool]] = [(expr, False)]  # (node, operands done?)
+    while stack:
+        node, done = stack.pop()
+        match node:
+            case Constant(value=v):
+                if not INT64_MIN <= v <= INT64_MAX:
+                    raise ValueError(f"Constant {v} does not fit in 64 bits")
+                op_code.append(CONST)
+                lhs.append(v)
+                rhs.append(0)
+            case Operator(operator=op) if done:
+                right_index = operands.pop()
+                left_index = operands.pop()
+                op_code.append(OP_CODES[op])
+                lhs.append(left_index)
+                rhs.append(right_index)
+            case Operator(left=left, right=right):
+                stack.append((node, True))
+                stack.append((right, False))
+                stack.append((left, False))
+                continue
+            case _:
+                raise ValueError(f"Invalid expression: {node}")
+        operands.append(len(op_code) - 1)
+    return op_code, lhs, rhs
+
+def evaluate_soa(op_code: array[int], lhs: array[int], rhs: array[int]) -> int:
+    """Evaluate an AST in array form with a single sweep"""
+    values: list[int] = []
+    push = values.append
+    for code, l, r in zip(op_code, lhs, rhs):
+        if code == CONST:
+            push(l)
+        elif code == ADD:
+            push(values[l] + values[r])
+        elif code == SUB:
+            push(values[l] - values[r])
+        else:
+            push(values[l] * values[r])
+    return values[-1]
 
 # %%
 
@@ -127,6 +242,8 @@ print(f"Expression: {test_expr1}")
 print("AST (tree view):")
 print(pretty_print(ast1))
 print(f"Result: {evaluate(ast1)}")
+print(f"Result (arrays): {evaluate_soa(*compile_to_soa(ast1))}")
+print(f"AST folded at parse time: {pretty_print(parse(test_expr1, fold=True))}")
 print()
 
 print(f"Expression: {test_expr2}")
@@ -140,3 +257,24 @@ print("AST (tree view):")
 print(pretty_print(ast3))
 print(f"Result: {evaluate(ast3)}")
 print()
+
+# Negative literals: "-" is a sign where an operand is expected
+for test_expr in ["1 - -5", "-5 + 3", "1-5"]:
+    print(f"Expression: {test_expr}")
+    print("AST (tree view):")
+    print(pretty_print(parse(test_expr)))
+    print(f"Result: {evaluate(parse(test_expr))}")
+    print()
+
+# The array form only holds 64-bit constants; the tree has no such limit
+big = parse("99999999999999999999 + 1")
+print("Expression: 99999999999999999999 + 1")
+print(f"Result: {evaluate(big)}")
+try:
+    print(f"Result (arrays): {evaluate_soa(*compile_to_soa(big))}")
+except ValueError as e:
+    print(f"Result (arrays): {e}")
+# Results are not limited, only constants are
+max_sum = parse(f"{INT64_MAX} + {INT64_MAX}")
+print(f"Expression: {INT64_MAX} + {INT64_MAX}")
+print(f"Result (arrays): {evaluate_soa(*compile_to_soa(max_sum))}")
@@ -5,6 +5,7 @@ This module demonstrates various use cases of type hints and structural pattern
 """
 
 from __future__ import annotations
+from array import array
 from dataclasses import dataclass
 from typing import Literal
 
@@ -17,6 +18,8 @@ from typing import Literal
 class Stack[T]:  # Python 3.12+ syntax for generic types
     """A generic stack implementation demonstrating type variables."""
 
+    __slots__ = ("items",)  # no per-instance __dict__; attribute access is faster
+
     def __init__(self) -> None:
         self.items: list[T] = []  # Use list[T] instead of List[T]
 
@@ -50,6 +53,32 @@ print("Peeked item:", stack_1.peek())  # Output: 2
 
 print("Stack contents:", stack_1)
 
+
+# The checks in pop and peek run on every call. When the caller already knows
+# the stack is not empty, they are wasted work: this variant drops them and
+# lets the underlying list raise IndexError instead. In really hot loops, a
+# bare list with append/pop is faster still, as it avoids the method calls.
+class StackFast[T]:
+    """A stack whose pop and peek raise IndexError when it is empty."""
+
+    __slots__ = ("items",)
+
+    def __init__(self) -> None:
+        self.items: list[T] = []
+
+    def push(self, item: T) -> None:
+        self.items.append(item)
+
+    def pop(self) -> T:
+        return self.items.pop()
+
+    def peek(self) -> T:
+        return self.items[-1]
+
+    def __str__(self) -> str:
+        return str(self.items)
+
+
 # %%
 
 
@@ -104,7 +133,7 @@ w: B = "world"
 
 
 # Records
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Person:
     name: str
     age: int
@@ -164,19 +193,29 @@ def process_lst(lst: list[int]) -> None:
             print(f"List: head {head}, tail {tail}")
 
 
+# A recursive sum_list matching `[head, *tail]` would copy the tail of the
+# list at every step (quadratic time) and hit the recursion limit on long lists.
 def sum_list(lst: list[int]) -> int:
-    match lst:
-        case []:
-            return 0
-        case [head, *tail]:
-            return head + sum_list(tail)
+    return sum(lst)  # the builtin walks the list once, in C
+
+
+# The same, spelled out as a loop
+def sum_list_iterative(lst: list[int]) -> int:
+    total = 0
+    for x in lst:
+        total += x
+    return total
+
+
+print(sum_list([1, 2, 3]))  # 6
+print(sum_list_iterative([1, 2, 3]))  # 6
 
 
 # %%
 
 
 # This should be fixed, it's mutually recursive
-@dataclass
+@dataclass(slots=True, frozen=True)
 class MyList[T]:
     head: T
     tail: MyBaseList[T]
@@ -190,17 +229,43 @@ my_list_3: MyBaseList[int] = MyList(
 
 
 def sum_list_2(lst: MyBaseList[int]) -> int:
-    match lst:
-        case None:
-            return 0
-        case MyList(head=x, tail=y):
-            return x + sum_list_2(y)
+    # Walk the chain of cells with a loop: no recursion, so no limit on length
+    total = 0
+    while lst is not None:
+        total += lst.head
+        lst = lst.tail
+    return total
 
 
 print(sum_list_2(my_list_3))  # 6
 
 
-@dataclass
+# Each cell of a MyList is a separate object somewhere in memory, and walking
+# the chain costs a few bytecodes per element. When a list is traversed many
+# times, it pays to copy it once into contiguous storage: array("q") stores
+# the values as raw 64-bit integers, one after the other, and the builtin sum
+# walks them in C.
+# Python ints have no size limit, though: if a value does not fit in 64 bits,
+# the values are copied into a plain list instead.
+def to_array(lst: MyBaseList[int]) -> array[int] | list[int]:
+    out = array("q")
+    while lst is not None:
+        try:
+            out.append(lst.head)
+        except OverflowError:
+            values = out.tolist()
+            while lst is not None:
+                values.append(lst.head)
+                lst = lst.tail
+            return values
+        lst = lst.tail
+    return out
+
+
+print(sum(to_array(my_list_3)))  # 6
+
+
+@dataclass(slots=True, frozen=True)
 class Sum:
     left: Expr
     right: Expr
@@ -217,10 +282,29 @@ def eval_expr(expr: Expr) -> int:
             return eval_expr(x) + eval_expr(y)
 
 
+# The same, without recursion: keep the sub-expressions still to visit on a
+# stack. Since Sum is the only operation, the result is the sum of all leaves.
+def eval_expr_iterative(expr: Expr) -> int:
+    total = 0
+    stack: list[Expr] = [expr]
+    while stack:
+        match stack.pop():
+            case int(x):
+                total += x
+            case Sum(left=x, right=y):
+                stack.append(y)
+                stack.append(x)
+    return total
+
+
+print(eval_expr(Sum(1, Sum(2, 3))))  # 6
+print(eval_expr_iterative(Sum(1, Sum(2, 3))))  # 6
+
+
 # %%
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Human:
     name: str
     drivingLicense: Literal[True, False]
@@ -231,7 +315,7 @@ x: Human = Human(name="John", drivingLicense=True)
 type DogKind = Literal["bulldog", "poodle", "labrador"]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Dog:
     name: str
     kind: DogKind
@@ -261,7 +345,7 @@ def describe_person_2(person: Record) -> str:
 
 
 # %%
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Car:
     make: str
     model: str
@@ -278,7 +362,7 @@ print(car2)  # Car(make='Honda', model='Civic', year=None)
 # %%
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Box[T]:
     content: T
     label: str
@@ -305,12 +389,12 @@ def process_box[T](box: Box[T]) -> None:
 type ArithExpr = Int | BinOp
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Int:
     value: int
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class BinOp:
     op: Literal["+", "-", "*"]
     left: ArithExpr
@@ -20,7 +20,12 @@ grammar = r"""
 """
 
 # Create the Lark parser
-parser = Lark(grammar, start="expr")
+# The grammar is LALR(1), so we can use Lark's linear-time table-driven parser
+# instead of the default Earley one; cache=True stores the generated tables on
+# disk, so later runs skip the grammar analysis.
+parser = Lark(
+    grammar, start="expr", parser="lalr", propagate_positions=False, cache=True
+)
 
 parse_tree = parser.parse("(1 + 2) - 3")
 
@@ -63,62 +68,93 @@ def print_tree(tree: Tree | Token):
 
 # %%
 
+import sys
 from dataclasses import dataclass
-from typing import Literal
+from typing import Callable, Literal, cast
 
 # Define AST types for the expression language
 type Op = Literal["+", "-", "*"]
 
+# The operator strings, interned: the parsers store exactly these objects in
+# the AST, so the evaluator can recognise an operator with a single identity
+# test (`is`) rather than comparing strings.
+PLUS, MINUS, TIMES, DIVIDE, MODULO = (sys.intern(c) for c in "+-*/%")
 
-@dataclass
-class Number:
-    value: int
 
-
-@dataclass
+# Number literals are stored directly as Python ints: a wrapper class for
+# them would only cost one extra object per leaf of the tree.
+@dataclass(slots=True, frozen=True)
 class BinaryExpression:
     op: Op
     left: Expression
     right: Expression
 
 
-type Expression = Number | BinaryExpression
+type Expression = int | BinaryExpression
 
 
 # %%
+# Each grammar rule gets its own small function, and transform_parse_tree
+# picks the right one from the rule name with a single dictionary lookup,
+# instead of trying the cases of a `match` one after the other.
+
+
+# Rules that just wrap one sub-tree
+WRAPPERS = frozenset({"expr", "mono", "paren"})
+
+
+def unwrap(tree: Tree) -> Tree:
+    # Skip any chain of wrappers (e.g. expr -> mono -> paren -> expr) in a loop
+    while tree.data in WRAPPERS:
+        [tree] = tree.children
+    return tree
+
+
+def transform_single_child(children: list) -> Expression:
+    [subtree] = children
+    return transform_parse_tree(unwrap(subtree))
+
+
+def transform_ground(children: list) -> Expression:
+    [number] = children
+    return int(number.value)
+
+
+def transform_bin(children: list) -> Expression:
+    # Since `bin: expr OP mono` is left-recursive, "1+2+...+n" gives a tree
+    # whose left spine is n levels deep: recurring on it would hit Python's
+    # recursion limit. Instead, walk down the spine with a loop, remembering
+    # operators and right operands, then build the AST back up bottom-first.
+    spine = []
+    while True:
+        left, op, right = children
+        spine.append((sys.intern(op.value), right))
+        left = unwrap(left)
+        if left.data != "bin":
+            break
+        children = left.children
+    result = transform_parse_tree(left)
+    for op, right in reversed(spine):
+        result = BinaryExpression(op=op, left=result, right=transform_parse_tree(right))
+    return result
+
+
+TRANSFORMERS: dict[str, Callable[[list], Expression]] = {
+    "expr": transform_single_child,
+    "mono": transform_single_child,
+    "paren": transform_single_child,
+    "ground": transform_ground,
+    "bin": transform_bin,
+}
+
+
 def transform_parse_tree(tree: str| Tree) -> Expression: # Q: why str??
-    match tree:
-        case Tree(data="expr", children=[subtree]):
-            return transform_parse_tree(subtree)
-        
-        case Tree(data="mono", children=[subtree]):
-            return transform_parse_tree(subtree)
-
-        case Tree(data="ground", children=[Token(type="NUMBER", value=actual_value)]):
-            return Number(value=int(actual_value))
-
-        case Tree(data="paren", children=[subtree]):
-            return transform_parse_tree(subtree)
-
-        case Tree(
-            data="bin",
-            children=[
-                left,
-                Token(type="OP", value=op),
-                right,
-            ],
-        ):
-            return BinaryExpression(
-                op=op,
-                left=transform_parse_tree(left),
-                right=transform_parse_tree(right),
-            )
-    
-        case _:
-            raise ValueError(f"Unknown parse tree node: {tree}")
+    if isinstance(tree, Tree) and tree.data in TRANSFORMERS:
+        return TRANSFORMERS[tree.data](tree.children)
+    raise ValueError(f"Unknown parse tree node: {tree}")
         
 
-def parse_ast(expression: str) -> Expression:
+def parse_ast_lark(expression: str) -> Expression:
     parse_tree = parser.parse(expression)
     return transform_parse_tree(parse_tree)
 
@@ -126,12 +162,109 @@ def parse_ast(expression: str) -> Expression:
 example = "(1+2)-3"
 
 # example = "1+2"
-ast = parse_ast(example)
+ast = parse_ast_lark(example)
 
 # print(ast)
 
 # %%
 
+# Alternative approach: a hand-written recursive-descent parser.
+# The grammar is small enough to be parsed directly, with one function per rule,
+# building the AST without going through a Lark parse tree first.
+# The left-recursive rule `bin: expr OP mono` becomes a loop:
+#
+#     expr: mono (OP mono)*
+#     mono: NUMBER | "(" expr ")"
+#
+# Note that, just like the grammar, all operators have the same precedence and
+# associate to the left.
+
+import operator
+import re
+from functools import lru_cache
+
+TOKEN_PATTERN = re.compile(
+    r"\s*(?:(?P<NUMBER>[0-9]+)|(?P<OP>[-+*/%])|(?P<LPAR>\()|(?P<RPAR>\))|(?P<ERROR>\S))"
+)
+
+type TokenList = list[tuple[str, str]]  # (kind, text) pairs
+
+
+def tokenize(expression: str) -> TokenList:
+    tokens: TokenList = []
+    for m in TOKEN_PATTERN.finditer(expression):
+        kind = cast(str, m.lastgroup)  # every alternative is a named group
+        if kind == "ERROR":
+            raise ValueError(f"Unexpected character: {m.group(kind)}")
+        tokens.append((kind, m.group(kind)))
+    return tokens
+
+
+# Used for constant folding: computing operations on literals while parsing
+FOLD_OPERATORS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.floordiv,
+    "%": operator.mod,
+}
+
+
+def parse_expr(tokens: TokenList, i: int, fold: bool = False) -> tuple[Expression, int]:
+    """expr: mono (OP mono)*"""
+    left, i = parse_mono(tokens, i, fold)
+    while i < len(tokens) and tokens[i][0] == "OP":
+        op = cast(Op, sys.intern(tokens[i][1]))
+        right, i = parse_mono(tokens, i + 1, fold)
+        # Both operands known: compute the result now. Division by zero is
+        # left in the tree, so that the error is still raised by evaluation.
+        if (
+            fold
+            and isinstance(left, int)
+            and isinstance(right, int)
+            and not (op in "/%" and right == 0)
+        ):
+            left = FOLD_OPERATORS[op](left, right)
+        else:
+            left = BinaryExpression(op=op, left=left, right=right)
+    return left, i
+
+
+def parse_mono(tokens: TokenList, i: int, fold: bool = False) -> tuple[Expression, int]:
+    """mono: NUMBER | "(" expr ")" """
+    if i >= len(tokens):
+        raise ValueError("Unexpected end of input")
+    kind, text = tokens[i]
+    if kind == "NUMBER":
+        return int(text), i + 1
+    if kind == "LPAR":
+        expr, i = parse_expr(tokens, i + 1, fold)
+        if i >= len(tokens) or tokens[i][0] != "RPAR":
+            raise ValueError("Expected )")
+        return expr, i + 1
+    raise ValueError(f"Unexpected token: {text}")
+
+
+# From here on, this is the parser we use: it builds the same ASTs as
+# parse_ast_lark, without the intermediate parse tree and the second pass.
+# ASTs are immutable, so the result for a given string can be cached and
+# shared: re-entering the same expression skips parsing altogether.
+# With fold=True, sub-expressions made only of literals are computed while
+# parsing (constant folding), so they cost nothing at evaluation time.
+@lru_cache(maxsize=1024)
+def parse_ast(expression: str, fold: bool = False) -> Expression:
+    tokens = tokenize(expression)
+    ast, i = parse_expr(tokens, 0, fold)
+    if i < len(tokens):
+        raise ValueError(f"Unexpected token: {tokens[i][1]}")
+    return ast
+
+
+# print(parse_ast(example) == parse_ast_lark(example))
+# print(parse_ast(example, fold=True))
+
+# %%
+
 # Exercise:
 # Add more operators. Implement the interpreter. Print the result. Add "/" and "%" operators.
 # Q: How will you handle division by zero?
@@ -140,31 +273,44 @@ ast = parse_ast(example)
 
 
 def evaluate(ast: Expression) -> int:
-    match ast:
-        case Number(value):
-            return value
-        case BinaryExpression(op, left, right):
-            left_value = evaluate(left)
-            right_value = evaluate(right)
-            match op:
-                case "+":
-                    return left_value + right_value
-                case "-":
-                    return left_value - right_value
-                case "*":
-                    return left_value * right_value
-                case "/":
-                    if right_value == 0:
-                        raise ValueError("Division by zero")
-                    return left_value // right_value
-                case "%":
-                    if right_value == 0:
-                        raise ValueError("Division by zero")
-                    return left_value % right_value
+    # Instead of recursion, we use two explicit stacks: `work` holds what is
+    # left to do, `values` holds the results of already evaluated operands.
+    # An operator string on `work` means "apply me to the top two values".
+    work: list[Expression | str] = [ast]
+    values: list[int] = []
+    # This is a hot loop, so the node kind is tested with plain isinstance
+    # checks, most frequent case first, rather than with a `match`.
+    while work:
+        item = work.pop()
+        if isinstance(item, BinaryExpression):
+            work.append(item.op)
+            work.append(item.right)
+            work.append(item.left)
+        elif isinstance(item, int):
+            values.append(item)
+        else:
+            right_value = values.pop()
+            left_value = values.pop()
+            # Operators in the AST are interned, see PLUS above
+            if item is PLUS:
+                values.append(left_value + right_value)
+            elif item is MINUS:
+                values.append(left_value - right_value)
+            elif item is TIMES:
+                values.append(left_value * right_value)
+            # No zero check of our own for "/" and "%": Python's integer
+            # division already does it, and raises ZeroDivisionError
+            elif item is DIVIDE:
+                values.append(left_value // right_value)
+            elif item is MODULO:
+                values.append(left_value % right_value)
+            else:
+                raise ValueError(f"Unknown operator: {item}")
+    return values[0]
 
 
 def evaluate_string(expression: str) -> int:
-    ast = parse_ast(expression)
+    ast = parse_ast(expression, fold=True)
     return evaluate(ast)
 
 
@@ -180,6 +326,8 @@ def REPL():
         else:
             try:
                 print(evaluate_string(expression))
+            except ZeroDivisionError:
+                print("Division by zero")
             except Exception as e:
                 print(e)
 
@@ -188,64 +336,111 @@ def REPL():
 
 # %%
 
+# Alternative approach: compile the AST to "bytecode" for a stack machine.
+# The tree is flattened once, in postfix order (operands before their operator);
+# running the code is then a single loop over a list, with no recursion and
+# with operators already resolved to small integers.
+
+PUSH, ADD, SUB, MUL, DIV, MOD = range(6)
+OPCODES = {"+": ADD, "-": SUB, "*": MUL, "/": DIV, "%": MOD}
+
+type Bytecode = list[tuple[int, int]]  # (opcode, argument) pairs
+
+
+def compile_ast(ast: Expression) -> Bytecode:
+    code: Bytecode = []
+    work: list[Expression | str] = [ast]
+    while work:
+        match work.pop():
+            case int(value):
+                code.append((PUSH, value))
+            case BinaryExpression(op, left, right):
+                work.append(op)
+                work.append(right)
+                work.append(left)
+            case str(op):
+                if op not in OPCODES:
+                    raise ValueError(f"Unknown operator: {op}")
+                code.append((OPCODES[op], 0))
+    return code
+
+
+def run(code: Bytecode) -> int:
+    stack: list[int] = []
+    for opcode, arg in code:
+        if opcode == PUSH:
+            stack.append(arg)
+            continue
+        right = stack.pop()
+        left = stack[-1]
+        if opcode == ADD:
+            stack[-1] = left + right
+        elif opcode == SUB:
+            stack[-1] = left - right
+        elif opcode == MUL:
+            stack[-1] = left * right
+        elif opcode == DIV:  # raises ZeroDivisionError if right == 0
+            stack[-1] = left // right
+        else:
+            stack[-1] = left % right
+    return stack[0]
+
+
+# print(compile_ast(parse_ast("(1+2)-3")))
+# print(run(compile_ast(parse_ast("(1+2)-3"))))
+
+# %%
+
 # Alternative approach: Using an operator environment
 # Instead of hardcoding operators in match statements, we can use a dictionary
 # that maps operator strings to binary functions
 
-from typing import Callable
-
 # Define the operator environment as a mapping from strings to binary functions
 type BinaryOp = Callable[[int, int], int]
 type OperatorEnv = dict[str, BinaryOp]
 
 
-def safe_div(a: int, b: int) -> int:
-    """Integer division with zero check"""
-    if b == 0:
-        raise ValueError("Division by zero")
-    return a // b
-
-
-def safe_mod(a: int, b: int) -> int:
-    """Modulo with zero check"""
-    if b == 0:
-        raise ValueError("Division by zero")
-    return a % b
-
-def plus(x,y):
-    return x+y
-
-def minus(x,y):
-    return x-y
-
-def multiply(x,y):
-    return x*y
-
 # Create the operator environment
+# The standard library already provides all our operators as functions, in the
+# `operator` module; being implemented in C, they are cheaper to call than
+# functions (or lambdas) of our own. Division by zero needs no special care:
+# floordiv and mod raise ZeroDivisionError by themselves.
 operator_env: OperatorEnv = {
-    "+": plus,
-    "-": minus,
-    "*": multiply,
-    "/": safe_div,
-    "%": safe_mod,
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.floordiv,
+    "%": operator.mod,
 }
 
 
 # %%
 
 
-def evaluate_with_env(ast: Expression, env: OperatorEnv) -> int:
-    """Evaluate an expression using an operator environment"""
-    match ast:
-        case Number(value):
-            return value
-        case BinaryExpression(op, left, right):
-            left_value = evaluate_with_env(left, env)
-            right_value = evaluate_with_env(right, env)
-            if op in env:
-                return env[op](left_value, right_value)
-            else:
-                raise ValueError(f"Unknown operator: {op}")
+def evaluate_with_env(
+    ast: Expression, env: OperatorEnv, cache: dict[int, int] | None = None
+) -> int:
+    """Evaluate an expression using an operator environment.
+    Results of binary nodes are remembered in `cache`, keyed by node identity,
+    so a sub-tree shared by several parents is only evaluated once.
+    """
+    if cache is None:
+        # A fresh cache per evaluation: ids are only meaningful while the
+        # tree is alive, and results depend on the environment
+        cache = {}
+    if isinstance(ast, int):
+        return ast
+    key = id(ast)
+    if key in cache:
+        return cache[key]
+    left_value = evaluate_with_env(ast.left, env, cache)
+    right_value = evaluate_with_env(ast.right, env, cache)
+    fn = env.get(ast.op)
+    if fn is None:
+        raise ValueError(f"Unknown operator: {ast.op}")
+    result = fn(left_value, right_value)
+    cache[key] = result
+    return result
 
 
 # %%
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
+import re
+import sys
+from collections import ChainMap
 from dataclasses import dataclass
-from typing import Any, Callable, Literal, TypeAlias, Union
-from lark import Lark, Token, Tree
+from functools import lru_cache
+from typing import Any, Callable, Literal, TypeAlias, Union, cast
+from lark import Lark, Transformer
 
 
 # Define the semantic domains
@@ -10,8 +14,12 @@ from lark import Lark, Token, Tree
 type DenOperator = Callable[[int, int], int] 
 type DVal = DenOperator  # Denotable values: can be stored in environment
 
-# Environment as a function
-type Environment = Callable[[str], DVal]
+# Environment: conceptually a function from identifiers to denotable values.
+# We represent it by its table: a ChainMap is a list of dicts, searched in
+# order. Looking up a name is one hash probe per dict, instead of a chain of
+# Python function calls, one per binding; and adding bindings prepends a new
+# dict, without copying (or modifying) the existing ones.
+type Environment = ChainMap[str, DVal]
 
 # Define grammar for parsing
 grammar = r"""
@@ -33,22 +41,15 @@ grammar = r"""
 """
 # Note: bin rule is left-associative, implementing left recursive parsing
 # The IDENTIFIER rule is used to match variable names, but it's unused now. As an exercise, you will use it to extend the language with numeric constants.
-# Create the Lark parser
-
-parser = Lark(grammar, start="expr")
+# The grammar is implemented twice below: with Lark (parse_ast_lark), and by a
+# hand-written parser (parse_ast), which is the one used by evaluate_string.
 
 
 # Define operators
-def add(x: int, y: int) -> int:
-    return x + y
-
-
-def subtract(x: int, y: int) -> int:
-    return x - y
-
-
-def multiply(x: int, y: int) -> int:
-    return x * y
+# The standard `operator` module already provides +, - and * as functions.
+# Being implemented in C, they are cheaper to call than functions of our own,
+# and every binary node of the AST calls one.
+from operator import add, mul as multiply, sub as subtract
 
 
 def divide(x: int, y: int) -> int:
@@ -65,51 +66,52 @@ def modulo(x: int, y: int) -> int:
 
 # Environment primitives
 def empty_environment() -> Environment:
-    """Create an empty environment function"""
+    """Create an empty environment"""
+    return ChainMap()
 
-    def env(name: str) -> DVal:
-        raise ValueError(f"Undefined identifier: {name}")
 
-    return env
+# Marks a missing identifier in lookup: unlike None, it can not be a value
+MISSING = object()
 
 
 def lookup(env: Environment, name: str) -> DVal:
     """Look up an identifier in the environment"""
-    return env(name)
+    value = env.get(name, MISSING)  # a single probe, instead of `in` then []
+    if value is MISSING:
+        raise ValueError(f"Undefined identifier: {name}")
+    return cast(DVal, value)  # not MISSING, so it is a DVal
 
 
 def bind(env: Environment, name: str, value: DVal) -> Environment:
     """Create new environment with an added binding"""
-
-    def new_env(n: str) -> DVal:
-        if n == name:
-            return value
-        return env(n)
-
-    return new_env
+    # The original environment is shared, and left unchanged
+    return env.new_child({name: value})
 
 
 # Create initial environment with operators
 def create_initial_env() -> Environment:
     """Create an environment populated with standard operators"""
-    env = empty_environment()
-    env = bind(env, "+", add)
-    env = bind(env, "-", subtract)
-    env = bind(env, "*", multiply)
-    env = bind(env, "/", divide)
-    env = bind(env, "%", modulo)
-    return env
+    return ChainMap(
+        {
+            "+": add,
+            "-": subtract,
+            "*": multiply,
+            "/": divide,
+            "%": modulo,
+        }
+    )
 
 
 # AST Definitions (based on the mini-interpreter from Lecture 3)
-@dataclass
+# Nodes are immutable, so that an AST can be safely shared (see parse_ast)
+@dataclass(slots=True, frozen=True)
 class Number:
     value: int
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class BinaryExpression:
-    op: str
+    op: str  # interned by the parsers, see below
     left: Expression
     right: Expression
 
@@ -117,83 +119,290 @@ class BinaryExpression:
 # Define Expression as a union type using the simplified Python 3.13 syntax
 type Expression = Number | BinaryExpression
 
-
-# Parse tree transformation function
-def transform_parse_tree(tree: Tree) -> Expression:
-    match tree:
-        case Tree(data="mono", children=[subtree]):
-            return transform_parse_tree(subtree)
-
-        case Tree(data="ground", children=[Token(type="NUMBER", value=actual_value)]):
-            return Number(value=int(actual_value))
-
-        case Tree(data="paren", children=[subtree]):
-            return transform_parse_tree(subtree)
-
-        case Tree(
-            data="bin",
-            children=[
-                left,
-                Token(type="OP", value=op),
-                right,
-            ],
-        ):
-            return BinaryExpression(
-                op=op,
-                left=transform_parse_tree(left),
-                right=transform_parse_tree(right),
-            )
-
-        case _:
-            raise ValueError(f"Unexpected parse tree structure")
-
-
+# Numbers are immutable, so the parser can share a single node for each small
+# value, just like Python does for small ints: "1+1+1" creates one Number(1).
+SMALL_NUMBERS = tuple(Number(value=i) for i in range(256))
+
+
+def make_number(value: int) -> Number:
+    """Return a shared Number for small values, a fresh one otherwise"""
+    return SMALL_NUMBERS[value] if 0 <= value < 256 else Number(value=value)
+
+
+# Parsing with Lark.
+# The parse tree is transformed into an AST by a Lark Transformer: one method
+# per rule, called bottom-up with the already transformed children. With the
+# LALR parser, Lark can call it while parsing, so that the parse tree is never
+# built at all.
+class ExpressionTransformer(Transformer):
+    def bin(self, children: list) -> Expression:
+        left, op, right = children
+        return BinaryExpression(op=sys.intern(op.value), left=left, right=right)
+
+    def mono(self, children: list) -> Expression:
+        return children[0]
+
+    def paren(self, children: list) -> Expression:
+        return children[0]
+
+    def ground(self, children: list) -> Expression:
+        return make_number(int(children[0]))
+
+
+# The grammar is LALR(1), so we use Lark's linear-time table-driven parser
+# instead of the default Earley one; cache=True stores the generated tables on
+# disk, so later runs skip the grammar analysis.
+ast_parser = Lark(
+    grammar,
+    start="expr",
+    parser="lalr",
+    maybe_placeholders=False,
+    transformer=ExpressionTransformer(),
+    cache=True,
+)
+
+
+def parse_ast_lark(expression: str) -> Expression:
+    """Parse a string expression into an AST, using Lark"""
+    return cast(Expression, ast_parser.parse(expression))
+
+
+# The grammar is small enough to be parsed by hand, with one function per rule
+# (as in Lecture 3): the AST is built directly, in a single pass, without
+# going through a Lark parse tree first. The left-recursive rule
+# `bin: expr OP mono` becomes a loop:
+#
+#     expr: mono (OP mono)*
+#     mono: NUMBER | "(" expr ")"
+#
+# so all operators have the same precedence and associate to the left.
+# Operators are interned (sys.intern) when the AST is built: the keys of the
+# environment are interned literals, so looking an operator up finds its key
+# by identity, without comparing the strings character by character.
+TOKEN_PATTERN = re.compile(
+    r"\s*(?:(?P<NUMBER>[0-9]+)|(?P<OP>[-+*/%])|(?P<LPAR>\()|(?P<RPAR>\))|(?P<ERROR>\S))"
+)
+
+type TokenList = list[tuple[str, str]]  # (kind, text) pairs
+
+
+def tokenize(expression: str) -> TokenList:
+    """Split a string expression into tokens"""
+    tokens: TokenList = []
+    for m in TOKEN_PATTERN.finditer(expression):
+        kind = cast(str, m.lastgroup)  # every alternative is a named group
+        if kind == "ERROR":
+            raise ValueError(f"Unexpected character: {m.group(kind)}")
+        tokens.append((kind, m.group(kind)))
+    return tokens
+
+
+def parse_expr(tokens: TokenList, i: int) -> tuple[Expression, int]:
+    """expr: mono (OP mono)*"""
+    left, i = parse_mono(tokens, i)
+    while i < len(tokens) and tokens[i][0] == "OP":
+        op = sys.intern(tokens[i][1])
+        right, i = parse_mono(tokens, i + 1)
+        left = BinaryExpression(op=op, left=left, right=right)
+    return left, i
+
+
+def parse_mono(tokens: TokenList, i: int) -> tuple[Expression, int]:
+    """mono: NUMBER | "(" expr ")" """
+    if i >= len(tokens):
+        raise ValueError("Unexpected end of input")
+    kind, text = tokens[i]
+    if kind == "NUMBER":
+        return make_number(int(text)), i + 1
+    if kind == "LPAR":
+        expr, i = parse_expr(tokens, i + 1)
+        if i >= len(tokens) or tokens[i][0] != "RPAR":
+            raise ValueError("Expected )")
+        return expr, i + 1
+    raise ValueError(f"Unexpected token: {text}")
+
+
+# The same expression is often entered more than once (e.g. in the REPL):
+# since ASTs are immutable, the result of parsing can be cached and reused.
+@lru_cache(maxsize=1024)
 def parse_ast(expression: str) -> Expression:
     """Parse a string expression into an AST"""
-    parse_tree = parser.parse(expression)
-    return transform_parse_tree(parse_tree)
+    tokens = tokenize(expression)
+    ast, i = parse_expr(tokens, 0)
+    if i < len(tokens):
+        raise ValueError(f"Unexpected token: {tokens[i][1]}")
+    return ast
+
+
+# print(parse_ast("(1+2)*3") == parse_ast_lark("(1+2)*3"))
 
 
 # Evaluate a parse tree with environment
 def evaluate(ast: Expression, env: Environment) -> int:
     """Evaluate an expression with given environment"""
-    match ast:
-        case Number(value):
-            return value
-        case BinaryExpression(op, left, right):
-            try:
+    # Instead of recursion, we use two explicit stacks: `work` holds what is
+    # left to do, `values` holds the results of already evaluated operands.
+    # An operator on `work` means "apply me to the top two values".
+    work: list[Expression | DenOperator] = [ast]
+    values: list[int] = []
+    # The environment does not change during evaluation, so each operator is
+    # looked up once, and then taken from this local table: a plain dict is
+    # faster to probe than the ChainMap, and needs no call to lookup.
+    operators: dict[str, DenOperator] = {}
+    # This is a hot loop, so the kind of each item is tested by comparing its
+    # exact type, rather than with a `match` on class patterns.
+    while work:
+        item = work.pop()
+        if type(item) is Number:
+            values.append(item.value)
+        elif type(item) is BinaryExpression:
+            op = item.op
+            operator = operators.get(op)
+            if operator is None:
                 # Get operator from environment
-                operator = lookup(env, op) # or simply operator = env(op)
+                operator = lookup(env, op) # env[op] would raise KeyError instead
+                # Checked here, when the operator is first looked up, rather
+                # than for every node: later nodes take it from `operators`
+                if not callable(operator):
+                    raise ValueError(f"{op} is not a function")
+                operators[op] = operator
 
-                # env : str -> DenOperator
-                # op : str 
-                # lookup(env, op) : DenOperator
+            # env : str -> DenOperator (as a table)
+            # op : str 
+            # lookup(env, op) : DenOperator
 
-                # Ensure it's a DenOperator
-                if not isinstance(operator, Callable):
+            # Evaluate operands (left first), then apply the operator
+            work.append(operator)
+            work.append(item.right)
+            work.append(item.left)
+        else:
+            # Apply the operator to the evaluated operands
+            right_value = values.pop()
+            left_value = values.pop()
+            values.append(cast(DenOperator, item)(left_value, right_value))
+    return values[0]
+
+
+# Compilation to bytecode for a stack machine.
+# Evaluating an AST walks the tree and looks up each operator in the
+# environment, every time. Both can be done once and for all: the tree is
+# flattened in postfix order (operands before their operator) into a list of
+# instructions, where operators are already resolved to their denotation.
+# Running the code is then a single loop, with no recursion and no lookups.
+# Operators denote pure functions, so the parts of an expression made only of
+# literals can even be computed by the compiler.
+# The pair "PUSH k; APPLY f", where the right operand is a constant, is very
+# common (think of 1+2+3+4): it is fused into a single APPLY_CONST (f, k)
+# "superinstruction", that saves one trip around the loop and one push/pop.
+PUSH, APPLY, APPLY_CONST = range(3)
+
+type Instruction = tuple[int, int | DenOperator | tuple[DenOperator, int]]
+type Bytecode = list[Instruction]  # (opcode, argument) pairs
+
+
+def compile_expr(ast: Expression, env: Environment) -> Bytecode:
+    """Compile an expression to bytecode, resolving operators in env"""
+    code: Bytecode = []
+    work: list[Expression | str] = [ast]
+    while work:
+        match work.pop():
+            case Number(value):
+                code.append((PUSH, value))
+            case BinaryExpression(op, left, right):
+                work.append(op)
+                work.append(right)
+                work.append(left)
+            case str(op):
+                operator = lookup(env, op)
+                if not callable(operator):
                     raise ValueError(f"{op} is not a function")
+                # Constant folding: if both operands are constants (two PUSH
+                # just before us), the operator is applied now, at compile
+                # time. Errors (e.g. division by zero) are left for run.
+                if len(code) >= 2 and code[-1][0] == PUSH and code[-2][0] == PUSH:
+                    try:
+                        value = operator(
+                            cast(int, code[-2][1]), cast(int, code[-1][1])
+                        )
+                    except ValueError:
+                        pass
+                    else:
+                        del code[-2:]
+                        code.append((PUSH, value))
+                        continue
+                if code[-1][0] == PUSH:
+                    code[-1] = (APPLY_CONST, (operator, cast(int, code[-1][1])))
+                else:
+                    code.append((APPLY, operator))
+    return code
+
+
+def run(code: Bytecode) -> int:
+    """Execute bytecode on a stack machine"""
+    stack: list[int] = []
+    for opcode, arg in code:
+        if opcode == PUSH:
+            stack.append(cast(int, arg))
+        elif opcode == APPLY_CONST:
+            operator, right = cast(tuple[DenOperator, int], arg)
+            stack[-1] = operator(stack[-1], right)
+        else:
+            right = stack.pop()
+            stack[-1] = cast(DenOperator, arg)(stack[-1], right)
+    return stack[0]
+
+
+# Going one step further, the bytecode can be turned into Python source code,
+# which CPython compiles to its own bytecode: running the result costs no
+# interpretation at all on our side, only the calls to the operators.
+# This pays off when the same expression is evaluated many times.
+def compile_to_python(ast: Expression, env: Environment) -> Callable[[], int]:
+    """Compile an expression to a Python function with no arguments"""
+    namespace: dict[str, DenOperator] = {}  # operator functions, by name
+    names: dict[DenOperator, str] = {}
+    stack: list[str] = []  # source code of the operands
+    for opcode, arg in compile_expr(ast, env):
+        if opcode == PUSH:
+            stack.append(repr(arg))
+            continue
+        if opcode == APPLY_CONST:
+            operator, right_value = cast(tuple[DenOperator, int], arg)
+            right = repr(right_value)
+        else:
+            operator = cast(DenOperator, arg)
+            right = stack.pop()
+        if operator not in names:
+            names[operator] = f"op{len(names)}"
+            namespace[names[operator]] = operator
+        stack[-1] = f"{names[operator]}({stack[-1]}, {right})"
+    return eval(f"lambda: {stack[0]}", namespace)
 
-                # Evaluate operands and apply operator
-                left_value = evaluate(left, env)
-                right_value = evaluate(right, env)
 
-                # Apply the operator to the evaluated operands
-                return operator(left_value, right_value)
-            except ValueError as e:
-                raise ValueError(f"Evaluation error: {e}")
+# An alternative to run(compile_expr(...)) in evaluate_string, for an
+# expression that is evaluated many times:
+# f = compile_to_python(parse_ast("(1+2)*3"), INITIAL_ENV)
+# print(f())
+
+
+# The initial environment is the same for every string, and it is never
+# modified (bind creates new environments), so it is created only once.
+INITIAL_ENV = create_initial_env()
 
 
 def evaluate_string(expression: str) -> int:
     """Evaluate a string expression using the initial environment"""
     ast = parse_ast(expression)
-    env = create_initial_env()
-    return evaluate(ast, env)
+    env = INITIAL_ENV
+    # Errors raised while evaluating get some context here, once
+    try:
+        return run(compile_expr(ast, env))
+    except ValueError as e:
+        raise ValueError(f"Evaluation error: {e}")
 
 
 # Example usage
 def REPL():
     """Read-Evaluate-Print Loop with environment"""
-    env = create_initial_env()
     exit = False
 
     print("Mini-interpreter with environment (type 'exit' to quit)")
@@ -206,10 +415,7 @@ def REPL():
             exit = True
         else:
             try:
-                # In a real implementation, this would use a proper parser
-                # For now, we use our simplified parse_ast
-                ast = parse_ast(expression)
-                result = evaluate(ast, env)
+                result = evaluate_string(expression)
                 print(result)
             except Exception as e:
                 print(e)
@@ -229,13 +435,12 @@ def run_tests():
         "10%(2+3)",
     ]
 
-    env = create_initial_env()
-
     print("Running tests:")
     for expr in test_expressions:
         try:
-            ast = parse_ast(expr)
-            result = evaluate(ast, env)
+            result = evaluate_string(expr)
+            # Cross-check the bytecode against the tree-walking evaluator
+            assert evaluate(parse_ast(expr), INITIAL_ENV) == result
             print(f"{expr} = {result}")
         except Exception as e:
             print(f"{expr} -> Error: {e}")
@@ -1,54 +1,57 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import Callable
-from lark import Lark, Token, Tree
+from functools import lru_cache
+from typing import Callable, cast
+from lark import Lark, Transformer
 
 
 # Define the semantic domains
 type DenOperator = Callable[[int, int], int]
 type DVal = DenOperator | int  # Denotable values: can be stored in environment
 
-# Environment as a function
-type Environment = Callable[[str], DVal]
+# Environment: conceptually a function from identifiers to denotable values.
+# We represent it by its table, a dict: looking up a name (which happens for
+# every variable and every operator) is then a single hash probe, instead of
+# a chain of function calls, one per enclosing binding.
+type Environment = dict[str, DVal]
 
 
 # Environment primitives
 def empty_environment() -> Environment:
-    """Create an empty environment function"""
-
-    def env(name: str) -> DVal:
-        raise ValueError(f"Undefined identifier: {name}")
-
-    return env
+    """Create an empty environment"""
+    return {}
 
 
 # Create initial environment with operators
 def create_initial_env() -> Environment:
     """Create an environment populated with standard operators"""
-    env = empty_environment()
-    env = bind(env, "+", add)
-    env = bind(env, "-", subtract)
-    env = bind(env, "*", multiply)
-    env = bind(env, "/", divide)
-    env = bind(env, "%", modulo)
-    return env
+    return {
+        "+": add,
+        "-": subtract,
+        "*": multiply,
+        "/": divide,
+        "%": modulo,
+    }
+
+
+# Marks a missing identifier in lookup: unlike None, it can not be a value
+MISSING = object()
 
 
 def lookup(env: Environment, name: str) -> DVal:
     """Look up an identifier in the environment"""
-    return env(name)
+    value = env.get(name, MISSING)  # a single probe, instead of `in` then []
+    if value is MISSING:
+        raise ValueError(f"Undefined identifier: {name}")
+    return cast(DVal, value)  # not MISSING, so it is a DVal
 
 
 def bind(env: Environment, name: str, value: DVal) -> Environment:
     """Create new environment with an added binding"""
-
-    def new_env(n: str) -> DVal:
-        if n == name:
-            return value
-        return env(n)
-
-    return new_env
+    # A new dict: the original environment is left unchanged, so that it is
+    # still valid outside the scope of the binding (e.g. after a let)
+    return {**env, name: value}
 
 
 # Define grammar for parsing
@@ -61,7 +64,8 @@ grammar = r"""
     bin: expr OP mono        
     ground: NUMBER 
     ident: IDENTIFIER
-    let: "let" IDENTIFIER "=" expr "in" expr
+    let: "let" IDENTIFIER "=" expr "in" body
+    ?body: mono | let
     var: IDENTIFIER
 
     NUMBER: /[0-9]+/
@@ -74,22 +78,18 @@ grammar = r"""
 """
 # Note: bin rule is left-associative, implementing left recursive parsing
 # The IDENTIFIER rule is used to match variable names, but it's unused now. As an exercise, you will use it to extend the language with numeric constants.
-# Create the Lark parser
-
-parser = Lark(grammar, start="expr")
+# The body of a let stops before the first operator, so that
+# "let x = 3 in x + 1" means "(let x = 3 in x) + 1" (see the first comment).
+# This is how the Earley parser used to resolve the ambiguity of the body being
+# any expr; with body limited to mono or let, the grammar is not ambiguous, and
+# it is LALR(1).
 
 
 # Define operators
-def add(x: int, y: int) -> int:
-    return x + y
-
-
-def subtract(x: int, y: int) -> int:
-    return x - y
-
-
-def multiply(x: int, y: int) -> int:
-    return x * y
+# The standard `operator` module already provides +, - and * as functions.
+# Being implemented in C, they are cheaper to call than functions of our own,
+# and every binary node of the AST calls one.
+from operator import add, mul as multiply, sub as subtract
 
 
 def divide(x: int, y: int) -> int:
@@ -105,24 +105,25 @@ def modulo(x: int, y: int) -> int:
 
 
 # AST Definitions (based on the mini-interpreter from Lecture 3)
-@dataclass
+# Nodes are immutable, so that an AST can be safely shared (see parse_ast)
+@dataclass(slots=True, frozen=True)
 class Number:
     value: int
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Var:
     name: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Let:
     name: str
     expr: Expression
     body: Expression
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class BinaryExpression:
     op: str
     left: Expression
@@ -132,116 +133,410 @@ class BinaryExpression:
 # Define Expression as a union type using the simplified Python 3.13 syntax
 type Expression = Number | BinaryExpression | Let | Var
 
+# Numbers and variables are immutable, so the parser can share a single node
+# for each small value and each name, just like Python does for small ints:
+# "let x = 1 in x+x+1" creates one Var("x") and one Number(1).
+SMALL_NUMBERS = tuple(Number(value=i) for i in range(256))
+VARS: dict[str, Var] = {}
+MAX_VARS = 4096  # bound on the number of shared Var nodes
 
-# Parse tree transformation function
-def transform_parse_tree(tree: Tree) -> Expression:
-    match tree:
-        case Tree(data="mono", children=[subtree]):
-            return transform_parse_tree(subtree)
-
-        case Tree(data="ground", children=[Token(type="NUMBER", value=actual_value)]):
-            return Number(value=int(actual_value))
-
-        case Tree(data="paren", children=[subtree]):
-            return transform_parse_tree(subtree)
-
-        case Tree(
-            data="bin",
-            children=[
-                left,
-                Token(type="OP", value=op),
-                right,
-            ],
-        ):
-            return BinaryExpression(
-                op=op,
-                left=transform_parse_tree(left),
-                right=transform_parse_tree(right),
-            )
 
-        case Tree(data="var", children=[Token(type="IDENTIFIER", value=name)]):
-            return Var(name=name)
-
-        case Tree(
-            data="let",
-            children=[
-                Token(type="IDENTIFIER", value=name),
-                expr,
-                body,
-            ],
-        ):
-            return Let(
-                name=name,
-                expr=transform_parse_tree(expr),
-                body=transform_parse_tree(body),
-            )
+def make_number(value: int) -> Number:
+    """Return a shared Number for small values, a fresh one otherwise"""
+    return SMALL_NUMBERS[value] if 0 <= value < 256 else Number(value=value)
+
 
-        case x:
-            print("******")
-            print(x.pretty())
-            print("******")
-            raise ValueError(f"Unexpected parse tree structure")
+def make_var(name: str) -> Var:
+    """Return a shared Var node for the given name"""
+    var = VARS.get(name)
+    if var is None:
+        var = Var(name=name)
+        if len(VARS) < MAX_VARS:
+            VARS[name] = var
+    return var
 
 
+# Parse tree transformation, as a Lark Transformer: one method per rule, called
+# bottom-up with the already transformed children. With the LALR parser, Lark
+# can call it while parsing, so that the parse tree is never built at all.
+class ExpressionTransformer(Transformer):
+    def mono(self, children: list) -> Expression:
+        return children[0]
+
+    def ground(self, children: list) -> Expression:
+        return make_number(int(children[0]))
+
+    def paren(self, children: list) -> Expression:
+        return children[0]
+
+    def bin(self, children: list) -> Expression:
+        left, op, right = children
+        return BinaryExpression(op=op.value, left=left, right=right)
+
+    def var(self, children: list) -> Expression:
+        return make_var(children[0].value)
+
+    def let(self, children: list) -> Expression:
+        name, expr, body = children
+        return Let(name=name.value, expr=expr, body=body)
+
+
+# Create the Lark parser
+# The grammar is LALR(1), so we use Lark's linear-time table-driven parser
+# instead of the default Earley one; cache=True stores the generated tables on
+# disk, so later runs skip the grammar analysis.
+ast_parser = Lark(
+    grammar,
+    start="expr",
+    parser="lalr",
+    maybe_placeholders=False,
+    transformer=ExpressionTransformer(),
+    cache=True,
+)
+
+
+# The same expression is often entered more than once (e.g. in the REPL):
+# since ASTs are immutable, the result of parsing can be cached and reused.
+@lru_cache(maxsize=4096)
 def parse_ast(expression: str) -> Expression:
     """Parse a string expression into an AST"""
-    parse_tree = parser.parse(expression)
-    return transform_parse_tree(parse_tree)
+    return cast(Expression, ast_parser.parse(expression))
+
+
+# Constant folding.
+# Before evaluation, the parts of an expression that only involve numbers can
+# be computed once and for all: a binary expression with two numbers as
+# operands becomes a number, and a variable bound by a let to a number is
+# replaced by that number in the body of the let (the let then disappears).
+# As in evaluate, operators are taken from env. Division by zero is left in
+# the tree, so that the error is still raised by evaluation.
+def fold(
+    ast: Expression, env: Environment, constants: dict[str, Number] | None = None
+) -> Expression:
+    """Fold the constant parts of an expression; constants maps the names
+    bound to numbers by the enclosing lets"""
+    if constants is None:
+        constants = {}
+    # No recursion, as in evaluate: `work` holds what is left to do and
+    # `folded` the sub-expressions folded so far. Besides (expression,
+    # constants) pairs, `work` can contain tagged tuples: ("binary", op) means
+    # "combine the top two folded values with op", ("let", name, body,
+    # constants) means "the top folded value is bound to name, now fold body",
+    # and ("let_body", name, expr) means "rebuild the let around the top one".
+    work: list[tuple] = [(ast, constants)]
+    folded: list[Expression] = []
+    while work:
+        match work.pop():
+            case ("binary", op):
+                right = folded.pop()
+                left = folded.pop()
+                match left, right:
+                    case Number(x), Number(y):
+                        operator = lookup(env, op)
+                        if callable(operator):
+                            try:
+                                folded.append(make_number(operator(x, y)))
+                                continue
+                            except ValueError:
+                                pass
+                folded.append(BinaryExpression(op=op, left=left, right=right))
+            case ("let", name, body, constants):
+                expr = folded.pop()
+                if isinstance(expr, Number):
+                    work.append((body, {**constants, name: expr}))
+                else:
+                    # The let hides any constant with the same name in its body
+                    inner = {k: v for k, v in constants.items() if k != name}
+                    work.append(("let_body", name, expr))
+                    work.append((body, inner))
+            case ("let_body", name, expr):
+                folded.append(Let(name=name, expr=expr, body=folded.pop()))
+            case (Number() as number, _):
+                folded.append(number)
+            case (BinaryExpression(op, left, right), constants):
+                work.append(("binary", op))
+                work.append((right, constants))
+                work.append((left, constants))
+            case (Let(name, expr, body), constants):
+                work.append(("let", name, body, constants))
+                work.append((expr, constants))
+            case (Var(name) as var, constants):
+                folded.append(constants.get(name, var))
+            case (unexpected, _):
+                raise ValueError(f"Unexpected expression type: {unexpected}")
+    return folded[0]
 
 
 # Evaluate a parse tree with environment
 def evaluate(ast: Expression, env: Environment) -> int:
     """Evaluate an expression with given environment"""
+    # Instead of recursion, we use two explicit stacks: `work` holds what is
+    # left to do, each item with the environment to do it in, and `values`
+    # holds the results of the sub-expressions evaluated so far. Besides
+    # expressions, `work` can contain an operator, meaning "apply me to the top
+    # two values", or a (name, body) pair, meaning "bind name to the top value
+    # and evaluate body in the extended environment". In recursive form:
+    #
+    #     case Let(name, expr, body):
+    #         value = evaluate(expr, env)
+    #         extended_env = bind(env, name, value)
+    #         return evaluate(body, extended_env)
+    work: list[tuple[Expression | DenOperator | tuple[str, Expression], Environment]]
+    work = [(ast, env)]
+    values: list[int] = []
+    # A let can only bind identifiers, so an operator means the same thing
+    # everywhere in ast: it is looked up the first time it is met, and then
+    # taken from here.
+    operators: dict[str, DenOperator] = {}
+    # As in the recursive version, errors get some context when they happen
+    # inside a binary expression: `binaries` counts the binary expressions
+    # that have been started, and whose operator has not been applied yet.
+    binaries = 0
+    try:
+        while work:
+            item, env = work.pop()
+            match item:
+                case Number(value):
+                    values.append(value)
+                case BinaryExpression(op, left, right):
+                    binaries += 1
+                    if op not in operators:
+                        # Get operator from environment. Operators are only
+                        # bound to functions (see create_initial_env), and
+                        # compile_expr is where the result gets checked.
+                        operators[op] = cast(DenOperator, lookup(env, op))
+                    operator = operators[op]
+
+                    # Evaluate operands (left first), then apply the operator
+                    work.append((operator, env))
+                    work.append((right, env))
+                    work.append((left, env))
+                case Let(name, expr, body):
+                    work.append(((name, body), env))
+                    work.append((expr, env))
+                case Var(name):
+                    x = lookup(env, name)
+                    match x:
+                        case int():
+                            values.append(x)
+                        case _:
+                            raise ValueError(f"Unexpected value type: {type(x)}")
+                case (name, body):
+                    value = values.pop()
+                    work.append((body, bind(env, name, value)))
+                case operator:
+                    # Apply the operator to the evaluated operands
+                    right_value = values.pop()
+                    left_value = values.pop()
+                    values.append(operator(left_value, right_value))
+                    binaries -= 1
+    except ValueError as e:
+        if binaries == 0:
+            raise
+        raise ValueError(f"Evaluation error: {e}")
+    return values[0]
+
+
+# Compilation to closures.
+# Every time a node is evaluated, `evaluate` has to find out what kind of node
+# it is (the `match`). This decision can be taken once and for all: each node
+# is compiled to a Python function that does just the work of that node,
+# calling the functions compiled for its children.
+# Operators can be resolved at compile time too: `let` only binds identifiers,
+# so the meaning of "+" can not change inside an expression. For the standard
+# operators, the compiled function even uses the Python operator directly.
+#
+# Variables bound by `let` are resolved at compile time as well. The compiler
+# knows how many `let`s enclose each point of the program (the level), so it
+# can number them: the value of the outermost one will be at position 0 of a
+# list, the next one at position 1, and so on ("slots"). At run time the
+# environment of the compiled code is just that list, and a variable is read
+# by indexing it.
+type Frame = list[int]  # values of the enclosing lets, outermost first
+type Compiled = Callable[[Frame], int]
+type Scope = dict[str, int]  # slot of each name bound by an enclosing let
+
+SPECIALIZED: dict[DenOperator, Callable[[Compiled, Compiled], Compiled]] = {
+    add: lambda l, r: lambda frame: l(frame) + r(frame),
+    subtract: lambda l, r: lambda frame: l(frame) - r(frame),
+    multiply: lambda l, r: lambda frame: l(frame) * r(frame),
+}
+
+
+def compile_expr(
+    ast: Expression,
+    env: Environment,
+    scope: Scope | None = None,
+    level: int = 0,
+    in_binary: bool = False,
+) -> Compiled:
+    """Compile an expression to a function of the values of enclosing lets.
+    Operators, and names not bound by a let, are looked up in env.
+    As in evaluate, errors inside a binary expression get some context."""
+    if scope is None:
+        scope = {}
     match ast:
         case Number(value):
-            return value
+            return lambda frame: value
         case BinaryExpression(op, left, right):
             try:
-                # Get operator from environment
                 operator = lookup(env, op)
-
-                # Ensure it's a DenOperator
-                if not isinstance(operator, Callable):
+                if not callable(operator):
                     raise ValueError(f"{op} is not a function")
-
-                # Evaluate operands and apply operator
-                left_value = evaluate(left, env)
-                right_value = evaluate(right, env)
-
-                # Apply the operator to the evaluated operands
-                return operator(left_value, right_value)
             except ValueError as e:
                 raise ValueError(f"Evaluation error: {e}")
-        # case Let(name, expr, body):
-        #     value = evaluate(expr, env)
-        #     extended_env = bind(env, name, value)
-        #     return evaluate(body, extended_env)
-        # case Var(name):
-        #     return lookup(env, name)
+            left_fn = compile_expr(left, env, scope, level, True)
+            right_fn = compile_expr(right, env, scope, level, True)
+            if operator in SPECIALIZED:
+                return SPECIALIZED[operator](left_fn, right_fn)
+
+            def apply(frame: Frame) -> int:
+                left_value = left_fn(frame)
+                right_value = right_fn(frame)
+                try:
+                    return operator(left_value, right_value)
+                except ValueError as e:
+                    raise ValueError(f"Evaluation error: {e}")
+
+            return apply
         case Let(name, expr, body):
-            value = evaluate(expr, env)
-            extended_env = bind(env, name, value)
-            return evaluate(body, extended_env)
+            expr_fn = compile_expr(expr, env, scope, level, in_binary)
+            # The new variable goes in the slot after those of the enclosing
+            # lets (a nested let can reuse the name, and gets its own slot)
+            slot = level
+            body_fn = compile_expr(
+                body, env, {**scope, name: slot}, level + 1, in_binary
+            )
+
+            def let(frame: Frame) -> int:
+                value = expr_fn(frame)
+                # Slots from ours onwards may still hold the values of lets
+                # that were evaluated before, and have already finished
+                del frame[slot:]
+                frame.append(value)
+                return body_fn(frame)
+
+            return let
+        case Var(name) if name in scope:
+            slot = scope[name]
+            return lambda frame: frame[slot]
         case Var(name):
-            x = lookup(env, name)
-            match x:
-                case int():
-                    return x
-                case _:
-                    raise ValueError(f"Unexpected value type: {type(x)}")
+
+            def var(frame: Frame) -> int:
+                try:
+                    x = lookup(env, name)
+                    if not isinstance(x, int):
+                        raise ValueError(f"Unexpected value type: {type(x)}")
+                except ValueError as e:
+                    if not in_binary:
+                        raise
+                    raise ValueError(f"Evaluation error: {e}")
+                return x
+
+            return var
+
+
+# Going one step further, an expression can be translated to Python source
+# code, which CPython compiles to its own bytecode: `let x = e in b` becomes
+# `(lambda v_x: b)(e)`, with operators called by name. Running the result costs
+# no interpretation at all on our side. This pays off when the same
+# expression is evaluated many times.
+def compile_to_python(ast: Expression, env: Environment) -> Callable[[], int]:
+    """Compile an expression to a Python function with no arguments"""
+    namespace: dict[str, Callable] = {}  # functions used by the code, by name
+    names: dict[DenOperator, str] = {}
+
+    def lookup_int(name: str) -> int:
+        # For names not bound by a let: looked up when the code runs
+        x = lookup(env, name)
+        if not isinstance(x, int):
+            raise ValueError(f"Unexpected value type: {type(x)}")
+        return x
+
+    namespace["lookup_int"] = lookup_int
+
+    def emit(ast: Expression, scope: frozenset[str]) -> str:
+        match ast:
+            case Number(value):
+                return repr(value)
+            case BinaryExpression(op, left, right):
+                bound = lookup(env, op)
+                if not callable(bound):
+                    raise ValueError(f"{op} is not a function")
+                operator: DenOperator = bound
+                if operator not in names:
+                    names[operator] = f"op{len(names)}"
+                    namespace[names[operator]] = operator
+                return f"{names[operator]}({emit(left, scope)}, {emit(right, scope)})"
+            case Let(name, expr, body):
+                # Python variables get a prefix, so they can not clash with
+                # keywords or with the names in namespace
+                body_code = emit(body, scope | {name})
+                return f"(lambda v_{name}: {body_code})({emit(expr, scope)})"
+            case Var(name) if name in scope:
+                return f"v_{name}"
+            case Var(name):
+                return f"lookup_int({name!r})"
+
+    return eval(f"lambda: {emit(ast, frozenset())}", namespace)
+
+
+# An alternative to compile_string, for an expression that is evaluated many
+# times (like the closures, it recurses once per level of nesting):
+# f = compile_to_python(parse_ast("let x = 2 in (x*x)"), INITIAL_ENV)
+# print(f())
+
+
+# compile_expr, and the functions it builds, call themselves once per level of
+# nesting: an expression deeper than this is run by evaluate instead, which
+# uses no recursion.
+MAX_COMPILE_DEPTH = 200
+
+
+def depth(ast: Expression) -> int:
+    """Nesting depth of an expression (computed without recursion)"""
+    result = 0
+    work: list[tuple[Expression, int]] = [(ast, 1)]
+    while work:
+        node, level = work.pop()
+        result = max(result, level)
+        match node:
+            case BinaryExpression(_, left, right):
+                work.append((left, level + 1))
+                work.append((right, level + 1))
+            case Let(_, expr, body):
+                work.append((expr, level + 1))
+                work.append((body, level + 1))
+    return result
+
+
+# The initial environment is the same for every string, and it is never
+# modified (bind creates new environments), so it is created only once.
+INITIAL_ENV = create_initial_env()
+
+
+# Folding and compiling cost more than evaluating once: they only pay off when
+# the result is reused, so it is cached for each string (the environment is
+# always INITIAL_ENV).
+@lru_cache(maxsize=4096)
+def compile_string(expression: str) -> Callable[[], int]:
+    """Parse, fold and compile a string expression in the initial environment"""
+    env = INITIAL_ENV
+    ast = fold(parse_ast(expression), env)
+    if depth(ast) > MAX_COMPILE_DEPTH:
+        return lambda: evaluate(ast, env)
+    compiled = compile_expr(ast, env)
+    return lambda: compiled([])
 
 
 def evaluate_string(expression: str) -> int:
     """Evaluate a string expression using the initial environment"""
-    ast = parse_ast(expression)
-    env = create_initial_env()
-    return evaluate(ast, env)
+    return compile_string(expression)()
 
 
 # Example usage
 def REPL():
     """Read-Evaluate-Print Loop with environment"""
-    env = create_initial_env()
     exit = False
 
     print("Mini-interpreter with environment (type 'exit' to quit)")
@@ -253,10 +548,7 @@ def REPL():
             exit = True
         else:
             try:
-                # In a real implementation, this would use a proper parser
-                # For now, we use our simplified parse_ast
-                ast = parse_ast(expression)
-                result = evaluate(ast, env)
+                result = evaluate_string(expression)
                 print(result)
             except Exception as e:
                 print(e)
@@ -285,13 +577,10 @@ def run_tests():
         "let x = 1 in let y = x+2 in 1 + x",
     ]
 
-    env = create_initial_env()
-
     print("Running tests:")
     for expr in test_expressions:
         try:
-            ast = parse_ast(expr)
-            result = evaluate(ast, env)
+            result = evaluate_string(expr)
             print(f"{expr} --> {result}")
         except Exception as e:
             print(f"{expr} -> Error: {e}")
@@ -6,9 +6,12 @@ Introduces a new syntax level beyond expressions: commands and command sequences
 
 from __future__ import annotations
 
+import io
+from contextlib import redirect_stdout
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Callable, Optional, cast
-from lark import Lark, Token, Tree
+from lark import Lark, Transformer
 
 
 # Define the semantic domains
@@ -22,21 +25,30 @@ type EVal = int  # Expressible value type (for expressions)
 type MVal = EVal  # Main value type for store and evaluation (expressible)
 type DVal = EVal | DenOperator | Loc  # Denotable values: can be associated with names
 
-type Environment = Callable[[str], DVal]
+# Environment: conceptually a function from identifiers to denotable values.
+# We represent it by its table, a dict: looking up a name (which happens for
+# every variable and every operator) is then a single hash probe, instead of
+# a chain of function calls, one per enclosing binding.
+type Environment = dict[str, DVal]
 
 
 # State (store) maps locations to memorizable values (MVal)
+# The store is represented by its table: locations are allocated one after the
+# other from 0, so the table is a list, indexed by address. Reading a location
+# is a single indexing, rather than a call through one closure per update ever
+# made. Writing is not cheaper, though: so that a State, once created, never
+# changes, allocate and update copy the whole list, which takes time
+# proportional to its length (a program with n declarations takes time
+# proportional to n * n). The compiled code (see run) avoids the copies, by
+# updating a single list in place.
 @dataclass
 class State:
-    store: Callable[[int], MVal]
+    store: list[MVal]
     next_loc: int
 
 
-def empty_store() -> Callable[[int], MVal]:
-    def store_fn(loc: int) -> MVal:
-        raise ValueError(f"Location {loc} not allocated")
-
-    return store_fn
+def empty_store() -> list[MVal]:
+    return []
 
 
 def empty_state() -> State:
@@ -45,39 +57,26 @@ def empty_state() -> State:
 
 def allocate(state: State, value: MVal) -> tuple[Loc, State]:
     loc = Loc(state.next_loc)
-    prev_store = state.store
-
-    def new_store(l: int) -> MVal:
-        if l == loc.address:
-            return value
-        return prev_store(l)
-
+    new_store = [*state.store, value]
     return loc, State(store=new_store, next_loc=loc.address + 1)
 
 
 def update(state: State, addr: int, value: MVal) -> State:
-    prev_store = state.store
-
-    def new_store(l: int) -> MVal:
-        if l == addr:
-            return value
-        return prev_store(l)
-
+    new_store = state.store.copy()
+    new_store[addr] = value
     return State(store=new_store, next_loc=state.next_loc)
 
 
 def access(state: State, addr: int) -> MVal:
-    return state.store(addr)
+    if addr >= len(state.store):
+        raise ValueError(f"Location {addr} not allocated")
+    return state.store[addr]
 
 
 # Environment primitives
 def empty_environment() -> Environment:
-    """Create an empty environment function"""
-
-    def env(name: str) -> int:
-        raise ValueError(f"Undefined identifier: {name}")
-
-    return env
+    """Create an empty environment"""
+    return {}
 
 
 # Create initial environment with operators and initial state
@@ -96,20 +95,23 @@ def create_initial_env_state() -> tuple[Environment, State]:
     return env, state
 
 
+# Marks a missing identifier in lookup: unlike None, it can not be a value
+MISSING = object()
+
+
 def lookup(env: Environment, name: str) -> DVal:
     """Look up an identifier's denotable value in the environment"""
-    return env(name)
+    value = env.get(name, MISSING)
+    if value is MISSING:
+        raise ValueError(f"Undefined identifier: {name}")
+    return cast(DVal, value)  # not MISSING, so it is a DVal
 
 
 def bind(env: Environment, name: str, value: DVal) -> Environment:
     """Create new environment with an added binding to a denotable value (location or operator)"""
-
-    def new_env(n: str) -> DVal:
-        if n == name:
-            return value
-        return env(n)
-
-    return new_env
+    # A new dict: the original environment is left unchanged, so that it is
+    # still valid outside the scope of the binding (e.g. after a let)
+    return {**env, name: value}
 
 
 # Define grammar for parsing
@@ -133,7 +135,8 @@ grammar = r"""
     bin: expr OP mono        
     ground: NUMBER 
     ident: IDENTIFIER
-    let: "let" IDENTIFIER "=" expr "in" expr
+    let: "let" IDENTIFIER "=" expr "in" body
+    ?body: mono | let
     var: IDENTIFIER
 
     NUMBER: /[0-9]+/
@@ -145,8 +148,10 @@ grammar = r"""
     %ignore WS
 """
 
-# Create the Lark parser
-parser = Lark(grammar, start="program")
+# The body of a let stops before the first operator, so that
+# "let x = 3 in x + 1" means "(let x = 3 in x) + 1". This is how the Earley
+# parser used to resolve the ambiguity of the body being any expr; with body
+# limited to mono or let, the grammar is not ambiguous, and it is LALR(1).
 
 
 # Define operators
@@ -231,132 +236,125 @@ class CommandSequence:
 type Command = Assign | Print | VarDecl
 
 
-# Parse tree transformation for expressions
-def transform_expr_tree(tree: Tree) -> Expression:
-    match tree:
-        case Tree(data="mono", children=[subtree]):
-            return transform_expr_tree(cast(Tree, subtree))
-
-        case Tree(data="ground", children=[Token(type="NUMBER", value=actual_value)]):
-            return Number(value=int(actual_value))
-
-        case Tree(data="paren", children=[subtree]):
-            return transform_expr_tree(cast(Tree, subtree))
-
-        case Tree(
-            data="bin",
-            children=[
-                left,
-                Token(type="OP", value=op),
-                right,
-            ],
-        ):
-            return BinaryExpression(
-                op=op,
-                left=transform_expr_tree(cast(Tree, left)),
-                right=transform_expr_tree(cast(Tree, right)),
-            )
+# Constant folding.
+# The operators of the language are fixed (a `let` or `var` can only bind
+# identifiers), so the parts of an expression that only involve numbers can be
+# computed while building the AST: a binary expression whose operands are both
+# numbers becomes a number, and a variable bound by a let to a number is
+# replaced by that number (the let then disappears).
+# Division by zero is left in the tree, so that the error is still raised
+# when (and if) the program gets there.
+FOLD_OPERATORS: dict[str, DenOperator] = {
+    "+": add,
+    "-": subtract,
+    "*": multiply,
+    "/": divide,
+    "%": modulo,
+}
+
+
+def make_binary(op: str, left: Expression, right: Expression) -> Expression:
+    """A BinaryExpression, or directly its value if the operands are numbers"""
+    if isinstance(left, Number) and isinstance(right, Number):
+        try:
+            return Number(value=FOLD_OPERATORS[op](left.value, right.value))
+        except ValueError:
+            pass
+    return BinaryExpression(op=op, left=left, right=right)
 
-        case Tree(data="var", children=[Token(type="IDENTIFIER", value=name)]):
-            return Var(name=name)
-
-        case Tree(
-            data="let",
-            children=[
-                Token(type="IDENTIFIER", value=name),
-                expr,
-                body,
-            ],
-        ):
-            return Let(
-                name=name,
-                expr=transform_expr_tree(cast(Tree, expr)),
-                body=transform_expr_tree(cast(Tree, body)),
-            )
 
-        case x:
-            print("******")
-            print(x.pretty())
-            print("******")
-            raise ValueError(f"Unexpected parse tree structure for expression")
-
-
-# Parse tree transformation for commands
-def transform_command_tree(tree: Tree) -> Command:
-    match tree:
-        case Tree(
-            data="assign",
-            children=[
-                Token(type="IDENTIFIER", value=name),
-                expr_tree,
-            ],
-        ):
-            return Assign(
-                name=name,
-                expr=transform_expr_tree(cast(Tree, expr_tree)),
-            )
+def make_let(name: str, expr: Expression, body: Expression) -> Expression:
+    """A Let, or directly its body with the value of name in it if it is a number"""
+    if isinstance(expr, Number):
+        return substitute(body, name, expr)
+    return Let(name=name, expr=expr, body=body)
 
-        case Tree(
-            data="print",
-            children=[expr_tree],
-        ):
-            return Print(
-                expr=transform_expr_tree(cast(Tree, expr_tree)),
-            )
 
-        case Tree(
-            data="vardecl",
-            children=[Token(type="IDENTIFIER", value=name), expr_tree],
-        ):
-            return VarDecl(
-                name=name,
-                expr=transform_expr_tree(cast(Tree, expr_tree)),
+def substitute(expr: Expression, name: str, value: Number) -> Expression:
+    """Replace the free occurrences of name in expr with value, folding again"""
+    match expr:
+        case Var(n) if n == name:
+            return value
+        case BinaryExpression(op, left, right):
+            return make_binary(
+                op, substitute(left, name, value), substitute(right, name, value)
             )
+        case Let(n, e, body):
+            # An inner let of the same name hides ours in its body
+            if n != name:
+                body = substitute(body, name, value)
+            return make_let(n, substitute(e, name, value), body)
+        case _:
+            return expr
 
-        case x:
-            print("******")
-            print(x.pretty())
-            print("******")
-            raise ValueError(f"Unexpected parse tree structure for command")
-
-
-# Parse tree transformation for command sequences
-def transform_command_seq_tree(tree: Tree) -> CommandSequence:
-    match tree:
-        case Tree(
-            data="command_seq",
-            children=[first_command, rest_seq],
-        ):
-            return CommandSequence(
-                first=transform_command_tree(cast(Tree, first_command)),
-                rest=transform_command_seq_tree(cast(Tree, rest_seq)),
-            )
 
-        case Tree(
-            data="command_seq",
-            children=[single_command],
-        ):
-            return CommandSequence(
-                first=transform_command_tree(cast(Tree, single_command)),
-            )
+# Parse tree transformation, as a Lark Transformer: one method per rule, called
+# bottom-up with the already transformed children. With the LALR parser, Lark
+# can call it while parsing, so that the parse tree is never built at all.
+class ProgramTransformer(Transformer):
+    # Expressions
+    def mono(self, children: list) -> Expression:
+        return children[0]
 
-        # Handle the case where the root is a single command node
-        case _ if tree.data in {"vardecl", "assign", "print"}:
-            return CommandSequence(
-                first=transform_command_tree(tree),
-            )
+    def ground(self, children: list) -> Expression:
+        return Number(value=int(children[0]))
+
+    def paren(self, children: list) -> Expression:
+        return children[0]
+
+    def bin(self, children: list) -> Expression:
+        left, op, right = children
+        return make_binary(op.value, left, right)
 
-        case x:
-            print("******")
-            print(x.pretty())
-            print("******")
-            raise ValueError(f"Unexpected parse tree structure for command sequence")
+    def var(self, children: list) -> Expression:
+        return Var(name=children[0].value)
+
+    def let(self, children: list) -> Expression:
+        name, expr, body = children
+        return make_let(name.value, expr, body)
+
+    # Commands
+    def assign(self, children: list) -> Command:
+        name, expr = children
+        return Assign(name=name.value, expr=expr)
+
+    def print(self, children: list) -> Command:
+        return Print(expr=children[0])
+
+    def vardecl(self, children: list) -> Command:
+        name, expr = children
+        return VarDecl(name=name.value, expr=expr)
+
+    # Command sequences: the last command of a sequence comes on its own
+    # (command_seq is inlined when it has a single child)
+    def command_seq(self, children: list) -> CommandSequence:
+        first, rest = children
+        if not isinstance(rest, CommandSequence):
+            rest = CommandSequence(first=rest)
+        return CommandSequence(first=first, rest=rest)
+
+
+# Create the Lark parser
+# The grammar is LALR(1), so we use Lark's linear-time table-driven parser
+# instead of the default Earley one; cache=True stores the generated tables on
+# disk, so later runs skip the grammar analysis.
+ast_parser = Lark(
+    grammar,
+    start="program",
+    parser="lalr",
+    maybe_placeholders=False,
+    transformer=ProgramTransformer(),
+    cache=True,
+)
 
 
 def parse_program(program_text: str) -> CommandSequence:
     """Parse a program string into a CommandSequence"""
-    parse_tree = parser.parse(program_text)
-    return transform_command_seq_tree(parse_tree)
+    result = cast(CommandSequence | Command, ast_parser.parse(program_text))
+    # A program made of a single command
+    if not isinstance(result, CommandSequence):
+        result = CommandSequence(first=result)
+    return result
 
 
 # Evaluate expressions with environment and state
@@ -410,19 +408,19 @@ def execute_command(
             new_env = bind(env, name, loc)
             return new_env, state1
         case Assign(name, expr):
+            # Only the target is looked up inside the try: errors raised while
+            # evaluating expr are reported as they are
             try:
                 dval = lookup(env, name)
-                match dval:
-                    case Loc(address=addr) as loc:
-                        value = evaluate_expr(expr, env, state)
-                        state1 = update(state, addr, value)
-                        return env, state1
-                    case _:
-                        raise ValueError(
-                            f"Assignment target '{name}' is not a variable"
-                        )
             except ValueError:
                 raise ValueError(f"Assignment to undeclared variable '{name}'")
+            match dval:
+                case Loc(address=addr):
+                    value = evaluate_expr(expr, env, state)
+                    state1 = update(state, addr, value)
+                    return env, state1
+                case _:
+                    raise ValueError(f"Assignment to undeclared variable '{name}'")
 
         case Print(expr):
             # MORALLY THIS IS THE IDENTITY FUNCTION
@@ -436,21 +434,204 @@ def execute_command_seq(
     seq: CommandSequence, env: Environment, state: State
 ) -> tuple[Environment, State]:
     """Execute a command sequence, returning the final environment and state"""
-    # Execute the first command
-    env1, state1 = execute_command(seq.first, env, state)
+    # The sequence is a linked list of commands: each one is executed with the
+    # environment and state left by the previous one. A loop, rather than a
+    # recursive call for the rest, so that long programs do not exhaust the
+    # Python stack.
+    current: CommandSequence | None = seq
+    while current is not None:
+        env, state = execute_command(current.first, env, state)
+        current = current.rest
+    return env, state
 
-    # If there are more commands, execute them with the updated environment and state
-    if seq.rest:
-        return execute_command_seq(seq.rest, env1, state1)
 
-    return env1, state1
+# Compilation to bytecode for a stack machine (as in Lecture 4).
+# Executing the AST means a `match` and a recursive call for every node, and a
+# lookup in the environment for every variable and operator. All of this can
+# be done once, before running: the program is flattened into a list of
+# instructions, which a single loop then executes one after the other.
+# There are no conditionals or loops yet, so the compiler knows which location
+# each `var` gets (the next free one, in order), and which location each name
+# denotes at each point of the program. Names bound by `let` are numbered by
+# nesting depth, as slots of a list of values ("lets").
+#   (PUSH, n)              push the number n
+#   (LOAD, addr)           push the value stored at location addr
+#   (LOAD_LET, slot)       push the value of an enclosing let
+#   (BIND_LET, slot)       let: pop the value of the new name into its slot
+#   (ADD / SUBTRACT / MULTIPLY, None)   arithmetic on the top two values
+#   (APPLY, (fn, prefix))  apply the operator fn to the top two values
+#   (ALLOC, None)          var: pop a value and store it at a new location
+#   (STORE, addr)          assignment: pop a value and store it at addr
+#   (PRINT, None)          pop a value and print it
+#   (FAIL, message)        raise an error found at compile time (e.g. an
+#                          undeclared variable), when execution reaches it
+# Error messages are the same as those of the AST interpreter, where each
+# binary expression around an error adds "Evaluation error: " to its message,
+# and a variable adds "Variable error: ". The compiler knows how many binary
+# expressions enclose each instruction, so it writes these prefixes into the
+# message of a FAIL; for an error raised by an operator (e.g. division by
+# zero), APPLY carries the prefix to add.
+PUSH, LOAD, LOAD_LET, BIND_LET, ADD, SUBTRACT, MULTIPLY, APPLY = range(8)
+ALLOC, STORE, PRINT, FAIL = range(8, 12)
+# The argument of an instruction: a number, an address or a slot (int), an
+# operator with an error prefix, an error message or nothing, depending on the
+# opcode
+type Argument = int | tuple[DenOperator, str] | str | None
+type Instruction = tuple[int, Argument]
+
+# Operators with an instruction of their own (the others use APPLY)
+OPERATOR_INSTRUCTIONS: dict[DenOperator, int] = {
+    add: ADD,
+    subtract: SUBTRACT,
+    multiply: MULTIPLY,
+}
 
 
-def execute_program(program_text: str) -> tuple[Environment, State]:
-    """Parse and execute a program, returning the final environment and state"""
+@dataclass
+class Program:
+    code: list[Instruction]
+    env: Environment  # the environment at the end of the program
+
+
+def compile_program(seq: CommandSequence, env: Environment, next_loc: int) -> Program:
+    """Compile a command sequence, to be run from env and a state whose first
+    free location is next_loc"""
+    code: list[Instruction] = []
+    # The environments in between are never seen from outside, so instead of
+    # a new one for each `var` (as bind does), a single copy is extended in
+    # place: the one of the caller stays as it was.
+    env = dict(env)
+
+    def compile_expr(
+        expr: Expression, scope: dict[str, int], depth: int, prefix: str = ""
+    ) -> None:
+        """Compile expr; prefix is added to the messages of its errors"""
+        match expr:
+            case Number(value):
+                code.append((PUSH, value))
+            case BinaryExpression(op, left, right):
+                prefix += "Evaluation error: "
+                fn = env.get(op, MISSING)
+                if fn is MISSING:
+                    code.append((FAIL, f"{prefix}Undefined identifier: {op}"))
+                elif not callable(fn):
+                    code.append((FAIL, f"{prefix}{op} is not a function"))
+                compile_expr(left, scope, depth, prefix)
+                compile_expr(right, scope, depth, prefix)
+                if fn in OPERATOR_INSTRUCTIONS:
+                    code.append((OPERATOR_INSTRUCTIONS[fn], None))
+                else:
+                    # Not reached if fn is not an operator: FAIL comes first
+                    code.append((APPLY, (cast(DenOperator, fn), prefix)))
+            case Let(name, expr, body):
+                compile_expr(expr, scope, depth, prefix)
+                code.append((BIND_LET, depth))
+                compile_expr(body, {**scope, name: depth}, depth + 1, prefix)
+            case Var(name):
+                prefix += "Variable error: "
+                dval = env.get(name, MISSING)
+                if name in scope:
+                    code.append((LOAD_LET, scope[name]))
+                elif dval is MISSING:
+                    code.append((FAIL, f"{prefix}Undefined identifier: {name}"))
+                elif isinstance(dval, Loc):
+                    code.append((LOAD, dval.address))
+                elif isinstance(dval, int):
+                    code.append((PUSH, dval))
+                else:
+                    message = f"Variable '{name}' does not refer to a value"
+                    code.append((FAIL, prefix + message))
+
+    current: CommandSequence | None = seq
+    while current is not None:
+        match current.first:
+            case VarDecl(name, expr):
+                compile_expr(expr, {}, 0)
+                code.append((ALLOC, None))
+                env[name] = Loc(next_loc)
+                next_loc += 1
+            case Assign(name, expr):
+                dval = env.get(name)
+                if isinstance(dval, Loc):
+                    compile_expr(expr, {}, 0)
+                    code.append((STORE, dval.address))
+                else:
+                    message = f"Assignment to undeclared variable '{name}'"
+                    code.append((FAIL, message))
+            case Print(expr):
+                compile_expr(expr, {}, 0)
+                code.append((PRINT, None))
+        current = current.rest
+    return Program(code=code, env=env)
+
+
+def run(program: Program, state: State) -> State:
+    """Run a compiled program from the given state, returning the final state"""
+    code = program.code
+    # Nobody else sees the state until the program ends, so there is no need
+    # for a new store at each update: a single copy is updated in place.
+    store = state.store.copy()
+    stack: list[int] = []
+    lets: list[int] = []  # values of the enclosing lets, outermost first
+    pc = 0
+    while pc < len(code):
+        opcode, arg = code[pc]
+        if opcode == PUSH:
+            stack.append(cast(int, arg))
+        elif opcode == LOAD:
+            stack.append(store[cast(int, arg)])
+        elif opcode == LOAD_LET:
+            stack.append(lets[cast(int, arg)])
+        elif opcode == BIND_LET:
+            # Slots from this one onwards may still hold the values of
+            # lets that have already finished
+            del lets[cast(int, arg) :]
+            lets.append(stack.pop())
+        elif opcode == ADD:
+            right = stack.pop()
+            stack[-1] += right
+        elif opcode == SUBTRACT:
+            right = stack.pop()
+            stack[-1] -= right
+        elif opcode == MULTIPLY:
+            right = stack.pop()
+            stack[-1] *= right
+        elif opcode == APPLY:
+            fn, prefix = cast(tuple[DenOperator, str], arg)
+            right = stack.pop()
+            try:
+                stack[-1] = fn(stack[-1], right)
+            except ValueError as e:
+                raise ValueError(f"{prefix}{e}")
+        elif opcode == ALLOC:
+            store.append(stack.pop())
+        elif opcode == STORE:
+            store[cast(int, arg)] = stack.pop()
+        elif opcode == PRINT:
+            print(stack.pop())
+        else:
+            raise ValueError(arg)
+        pc += 1
+    return State(store=store, next_loc=len(store))
+
+
+# A program that starts from the initial environment and state always compiles
+# to the same code, and running it does not change the code: the result of
+# parsing and compiling a given text can be cached and reused.
+@lru_cache(maxsize=512)
+def compile_text(program_text: str) -> Program:
+    """Parse and compile a program, to be run from the initial state"""
     command_seq = parse_program(program_text)
     env, state = create_initial_env_state()
-    return execute_command_seq(command_seq, env, state)
+    return compile_program(command_seq, env, state.next_loc)
+
+
+def execute_program(program_text: str) -> tuple[Environment, State]:
+    """Parse and execute a program, returning the final environment and state"""
+    program = compile_text(program_text)
+    _, state = create_initial_env_state()
+    # A copy of the environment, since the cached one must not be modified
+    return dict(program.env), run(program, state)
 
 
 # Example usage
@@ -470,11 +651,29 @@ def REPL():
         else:
             try:
                 command_seq = parse_program(program)
-                env, state = execute_command_seq(command_seq, env, state)
+                # Compiled in the environment left by the previous inputs, so
+                # that their variables are resolved to locations as well
+                compiled = compile_program(command_seq, env, state.next_loc)
+                state = run(compiled, state)
+                env = compiled.env
             except Exception as e:
                 print(f"Error: {e}")
 
 
+def run_captured(
+    execute: Callable[[], tuple[Environment, State]],
+) -> tuple[str, list[MVal] | str]:
+    """Call execute, capturing what it prints: return the output, and either
+    the final store or the error message"""
+    with redirect_stdout(io.StringIO()) as output:
+        try:
+            _, state = execute()
+            result: list[MVal] | str = state.store
+        except Exception as e:
+            result = f"Error: {e}"
+    return output.getvalue(), result
+
+
 def run_tests():
     """Run some test expressions to verify the parser and evaluator"""
     test_programs = [
@@ -488,17 +687,27 @@ def run_tests():
         "var x = let y = 5 in y * 2; print x",
         # Longer program with multiple operations
         "var x = 10; var y = 20; var z = x + y; print z; x <- 30; print x + y",
+        # Errors
+        "print x + 1",
+        "var x = 1; print 1 + (x / 0)",
+        "var x = 1; x <- let y = 0 in (x % y)",
+        "y <- 3",
     ]
 
     print("Running tests:")
     for program in test_programs:
         print(f"\nProgram: {program}")
-        try:
-            # Execute the program and discard the environment and state
-            execute_program(program)
-            print("Execution successful")
-        except Exception as e:
-            print(f"Error: {e}")
+        output, result = run_captured(lambda: execute_program(program))
+        print(output, end="")
+        print(result if isinstance(result, str) else "Execution successful")
+        # Cross-check the bytecode against the AST interpreter: same output,
+        # and the same final store or the same error
+        expected = run_captured(
+            lambda: execute_command_seq(
+                parse_program(program), *create_initial_env_state()
+            )
+        )
+        assert (output, result) == expected, expected
 
 
 if __name__ == "__main__":
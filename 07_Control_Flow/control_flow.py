@@ -7,6 +7,8 @@ Minimal changes from Lecture 6:
 3. All operators stored as Operator(type, fn) in environment
 4. Unified Apply node for all operator applications in AST
 5. Runtime type and arity checks for operators
+6. Short-circuit "and"/"or": the right operand is only evaluated (and
+   checked) when the left one does not determine the result
 
 Scoping rules: This language uses static (lexical) scoping with block-local variables. Variables declared inside a block (such as if, else, or while) are only visible within that block and are not accessible outside of it.
 
@@ -16,7 +18,7 @@ Block-local variables are allocated using a stack discipline: their memory locat
 
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Callable, cast
 from lark import Lark, Token, Tree
 
@@ -31,21 +33,27 @@ type EVal = int | bool  # Expressible value type (for expressions)
 type MVal = EVal  # Main value type for store and evaluation (expressible)
 type DVal = EVal | Loc | Operator  # Denotable values: can be associated with names
 
-type Environment = Callable[[str], DVal]
+# Environment: conceptually a function from identifiers to denotable values.
+# As for the store, we represent it by its table, a dict: looking up a name
+# (which happens for every variable and every operator) is then a single hash
+# probe, instead of a chain of function calls, one per enclosing binding.
+type Environment = dict[str, DVal]
 
 
 # State (store) maps locations to memorizable values (MVal)
+# The store is represented by its table: locations are allocated one after the
+# other from 0, so the table is a list, indexed by address. Reading a location
+# is a single indexing, rather than a call through one closure per update ever
+# made. Updates still build a new list, so that a State, once created, never
+# changes.
 @dataclass
 class State:
-    store: Callable[[int], MVal]
+    store: list[MVal]
     next_loc: int
 
 
-def empty_store() -> Callable[[int], MVal]:
-    def store_fn(loc: int) -> MVal:
-        raise ValueError(f"Location {loc} not allocated")
-
-    return store_fn
+def empty_store() -> list[MVal]:
+    return []
 
 
 def empty_state() -> State:
@@ -54,39 +62,31 @@ def empty_state() -> State:
 
 def allocate(state: State, value: MVal) -> tuple[Loc, State]:
     loc = Loc(state.next_loc)
-    prev_store = state.store
-
-    def new_store(l: int) -> MVal:
-        if l == loc.address:
-            return value
-        return prev_store(l)
-
+    new_store = state.store.copy()
+    if loc.address < len(new_store):
+        # A location freed at the end of a block is being reused
+        new_store[loc.address] = value
+    else:
+        new_store.append(value)
     return loc, State(store=new_store, next_loc=loc.address + 1)
 
 
 def update(state: State, addr: int, value: MVal) -> State:
-    prev_store = state.store
-
-    def new_store(l: int) -> MVal:
-        if l == addr:
-            return value
-        return prev_store(l)
-
+    new_store = state.store.copy()
+    new_store[addr] = value
     return State(store=new_store, next_loc=state.next_loc)
 
 
 def access(state: State, addr: int) -> MVal:
-    return state.store(addr)
+    if addr >= len(state.store):
+        raise ValueError(f"Location {addr} not allocated")
+    return state.store[addr]
 
 
 # Environment primitives
 def empty_environment() -> Environment:
-    """Create an empty environment function"""
-
-    def env(name: str) -> DVal:
-        raise ValueError(f"Undefined identifier: {name}")
-
-    return env
+    """Create an empty environment"""
+    return {}
 
 
 # Operator dataclass for type and function
@@ -190,20 +190,23 @@ def create_initial_env_state() -> tuple[Environment, State]:
     return env, state
 
 
+# Marks a missing identifier in lookup: unlike None, it can not be a value
+MISSING = object()
+
+
 def lookup(env: Environment, name: str) -> DVal:
     """Look up an identifier's denotable value in the environment"""
-    return env(name)
+    value = env.get(name, MISSING)
+    if value is MISSING:
+        raise ValueError(f"Undefined identifier: {name}")
+    return cast(DVal, value)  # not MISSING, so it is a DVal
 
 
 def bind(env: Environment, name: str, value: DVal) -> Environment:
     """Create new environment with an added binding to a denotable value (location or operator)"""
-
-    def new_env(n: str) -> DVal:
-        if n == name:
-            return value
-        return env(n)
-
-    return new_env
+    # A new dict: the original environment is left unchanged, so that it is
+    # still valid outside the scope of the binding (e.g. after a block)
+    return {**env, name: value}
 
 
 # Define grammar for parsing
@@ -250,28 +253,28 @@ parser = Lark(grammar, start="program")
 
 
 # AST Definitions for Expressions (based on Lecture 5)
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Number:
     value: int
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Bool:
     value: bool
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Var:
     name: str
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Apply:
     op: str
     args: list[Expression]
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Let:
     name: str
     expr: Expression
@@ -283,40 +286,42 @@ type Expression = Number | Bool | Var | Let | Apply
 
 
 # AST Definitions for Commands
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Assign:
     name: str
     expr: Expression
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Print:
     expr: Expression
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class VarDecl:
     name: str
     expr: Expression
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class CommandSequence:
     first: Command
     rest: CommandSequence | None = None
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class IfElse:
     cond: Expression
     then_branch: CommandSequence
     else_branch: CommandSequence
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class While:
     cond: Expression
     body: CommandSequence
+    # The bytecode of cond (see compile_expr), compiled once by the parser
+    cond_code: list[Instruction] = field(repr=False, compare=False)
 
 
 # Update Command type comment
@@ -433,10 +438,8 @@ def transform_command_tree(tree: Tree) -> Command:
                     first=transform_command_tree(cast(Tree, body_tree))
                 )
             )
-            return While(
-                cond=transform_expr_tree(cast(Tree, cond_tree)),
-                body=body_seq,
-            )
+            cond = transform_expr_tree(cast(Tree, cond_tree))
+            return While(cond=cond, body=body_seq, cond_code=compile_expr(cond))
 
         case x:
             print("******")
@@ -492,36 +495,24 @@ def evaluate_expr(expr: Expression, env: Environment, state: State) -> EVal:
             return value
         case Bool(value):
             return value
+        case Apply("and" | "or" as op, [left, right]):
+            # Short-circuit: when the left operand is enough to know the
+            # result (false for "and", true for "or"), the right one is not
+            # evaluated at all. Otherwise, proceed as for any operator.
+            # Walking the tree, every Apply is matched against this case
+            # first; compiled code (see compile_expr) pays nothing of the
+            # sort, since JUMP_IF is only emitted for "and" and "or".
+            left_val = evaluate_expr(left, env, state)
+            if type(left_val) is bool and left_val == (op == "or"):
+                return left_val
+            return apply_operator(op, [left_val, evaluate_expr(right, env, state)], env)
         case Apply(op, args):
             arg_vals = [
                 evaluate_expr(a, env, state) for a in args
             ]  # python idiom for list comprehension
-            op_val = lookup(env, op)
-            if isinstance(op_val, Operator):
-                expected_types, _ = op_val.type
-                if len(expected_types) != len(arg_vals):
-                    raise ValueError(
-                        f"Operator '{op}' expects {len(expected_types)} arguments, got {len(arg_vals)}"
-                    )
-                for i, (expected, actual) in enumerate(zip(expected_types, arg_vals)):
-                    if type(actual) is not expected:
-                        raise ValueError(
-                            f"Operator '{op}' argument {i+1} expects type {expected.__name__}, got {type(actual).__name__}"
-                        )
-                return op_val.fn(arg_vals)
-            raise ValueError(f"{op} is not an operator")
+            return apply_operator(op, arg_vals, env)
         case Var(name):
-            try:
-                dval = lookup(env, name)
-                match dval:
-                    case int() | bool():
-                        return dval
-                    case Loc(address=addr):
-                        return access(state, addr)
-                    case _:
-                        raise ValueError(f"Variable '{name}' does not refer to a value")
-            except ValueError as e:
-                raise ValueError(f"Variable error: {e}")
+            return load_var(name, env, state)
         case Let(name, expr, body):
             value = evaluate_expr(expr, env, state)
             extended_env = bind(env, name, value)
@@ -530,6 +521,121 @@ def evaluate_expr(expr: Expression, env: Environment, state: State) -> EVal:
             raise ValueError(f"Unexpected expression type: {expr}")
 
 
+def load_var(name: str, env: Environment, state: State) -> EVal:
+    """The value of a variable: its own, or that stored at its location"""
+    try:
+        dval = lookup(env, name)
+        match dval:
+            case int() | bool():
+                return dval
+            case Loc(address=addr):
+                return access(state, addr)
+            case _:
+                raise ValueError(f"Variable '{name}' does not refer to a value")
+    except ValueError as e:
+        raise ValueError(f"Variable error: {e}")
+
+
+def apply_operator(op: str, arg_vals: list[EVal], env: Environment) -> EVal:
+    """Apply the operator bound to op to already evaluated arguments"""
+    op_val = lookup(env, op)
+    if isinstance(op_val, Operator):
+        expected_types, _ = op_val.type
+        if len(expected_types) != len(arg_vals):
+            raise ValueError(
+                f"Operator '{op}' expects {len(expected_types)} arguments, got {len(arg_vals)}"
+            )
+        for i, (expected, actual) in enumerate(zip(expected_types, arg_vals)):
+            if type(actual) is not expected:
+                raise ValueError(
+                    f"Operator '{op}' argument {i+1} expects type {expected.__name__}, got {type(actual).__name__}"
+                )
+        return op_val.fn(arg_vals)
+    raise ValueError(f"{op} is not an operator")
+
+
+# Compilation of expressions to bytecode (as in Lecture 4).
+# The condition of a while loop is evaluated again at each iteration, walking
+# the same tree each time. Instead, it is flattened once, by the parser (see
+# While), into a list of instructions for a stack machine, which are then run
+# in a simple loop:
+#   (PUSH, v)               push the constant v
+#   (LOAD, name)            push the value of the variable name
+#   (APPLY, (op, n))        apply op to the top n values, push the result
+#   (JUMP_IF, (b, target))  short-circuit of "and" (b = False) and "or"
+#                           (b = True): if the top value is b, leave it there
+#                           and continue at target
+#   (BIND, name)            let: bind name to the top value (popped)
+#   (UNBIND, None)          end of let: back to the environment before BIND
+PUSH, LOAD, APPLY, JUMP_IF, BIND, UNBIND = range(6)
+# The argument of an instruction, depending on the opcode: a constant, a name,
+# an (operator, arity) pair, a (value, target) pair, or nothing
+type Argument = EVal | str | tuple[str, int] | tuple[bool, int] | None
+type Instruction = tuple[int, Argument]
+
+
+def compile_expr(expr: Expression) -> list[Instruction]:
+    """Compile an expression to bytecode"""
+    code: list[Instruction] = []
+
+    def emit(expr: Expression) -> None:
+        match expr:
+            case Number(value) | Bool(value):
+                code.append((PUSH, value))
+            case Apply("and" | "or" as op, [left, right]):
+                emit(left)
+                jump = len(code)
+                code.append((JUMP_IF, None))  # target is not known yet
+                emit(right)
+                code.append((APPLY, (op, 2)))
+                code[jump] = (JUMP_IF, (op == "or", len(code)))
+            case Apply(op, args):
+                for a in args:
+                    emit(a)
+                code.append((APPLY, (op, len(args))))
+            case Var(name):
+                code.append((LOAD, name))
+            case Let(name, expr, body):
+                emit(expr)
+                code.append((BIND, name))
+                emit(body)
+                code.append((UNBIND, None))
+            case _:
+                raise ValueError(f"Unexpected expression type: {expr}")
+
+    emit(expr)
+    return code
+
+
+def run_expr(code: list[Instruction], env: Environment, state: State) -> EVal:
+    """Run the bytecode of an expression: same result as evaluate_expr"""
+    stack: list[EVal] = []
+    envs: list[Environment] = []  # environments to go back to, for UNBIND
+    pc = 0
+    while pc < len(code):
+        opcode, arg = code[pc]
+        pc += 1
+        if opcode == PUSH:
+            stack.append(cast(EVal, arg))
+        elif opcode == LOAD:
+            stack.append(load_var(cast(str, arg), env, state))
+        elif opcode == APPLY:
+            op, n = cast(tuple[str, int], arg)
+            arg_vals = stack[len(stack) - n :]
+            del stack[len(stack) - n :]
+            stack.append(apply_operator(op, arg_vals, env))
+        elif opcode == JUMP_IF:
+            value, target = cast(tuple[bool, int], arg)
+            if type(stack[-1]) is bool and stack[-1] == value:
+                pc = target
+        elif opcode == BIND:
+            envs.append(env)
+            env = bind(env, cast(str, arg), stack.pop())
+        else:
+            env = envs.pop()
+    return stack[0]
+
+
 # Execute commands with environment and state
 def execute_command(
     cmd: Command, env: Environment, state: State
@@ -574,10 +680,12 @@ def execute_command(
                 _, state1 = execute_command_seq(else_branch, env, state)
                 state2 = State(store=state1.store, next_loc=saved_next_loc)
                 return env, state2
-        case While(cond, body):
-            
+        case While(cond, body, cond_code):
+            # The condition was compiled by the parser, and is run at each
+            # iteration
+
             def rec_fn (env: Environment, state: State) -> tuple[Environment, State]: 
-                cond_val = evaluate_expr(cond, env, state)
+                cond_val = run_expr(cond_code, env, state)
                 if not isinstance(cond_val, bool):
                     raise ValueError("While condition must be boolean")
                 saved_next_loc = state.next_loc                   
@@ -600,14 +708,15 @@ def execute_command_seq(
     seq: CommandSequence, env: Environment, state: State
 ) -> tuple[Environment, State]:
     """Execute a command sequence, returning the final environment and state"""
-    # Execute the first command
-    env1, state1 = execute_command(seq.first, env, state)
-
-    # If there are more commands, execute them with the updated environment and state
-    if seq.rest:
-        return execute_command_seq(seq.rest, env1, state1)
-
-    return env1, state1
+    # The sequence is a linked list of commands: each one is executed with the
+    # environment and state left by the previous one. A loop, rather than a
+    # recursive call for the rest, so that long programs do not exhaust the
+    # Python stack.
+    current: CommandSequence | None = seq
+    while current is not None:
+        env, state = execute_command(current.first, env, state)
+        current = current.rest
+    return env, state
 
 
 def execute_program(program_text: str) -> tuple[Environment, State]: